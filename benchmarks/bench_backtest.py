@@ -0,0 +1,61 @@
+# Times Backtest.run over a synthetic fight history for a grid of models and bet sizings,
+# after checking a few combinations against a plain per-fight replay.
+# usage: python -m benchmarks.bench_backtest [--fights 1000000] [--models 50] [--min_bets 10 50 100 200] [--max_bets 500 1000 2000 5000 10000]
+from saltybetter.db import saltydb
+from saltybetter import saltybacktest
+import argparse
+import math
+import time
+import numpy as np
+
+
+# the session's sizing rule, one fight at a time
+def replay(betas, x, y, min_bet, max_bet, start_balance):
+    balance = peak = start_balance
+    drawdown = 0
+    for features, winner in zip(x, y):
+        p = 1 / (1 + math.exp(-float(features @ betas)))
+        amount = abs(p - 0.5) / 0.5 * (max_bet - min_bet) + min_bet
+        balance += amount if (p > 0.5) == (winner == 1) else -amount
+        peak = max(peak, balance)
+        drawdown = max(drawdown, peak - balance)
+    return balance, drawdown
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fights', type=int, default=1000000)
+    arg_parser.add_argument('--models', type=int, default=50)
+    arg_parser.add_argument('--min_bets', nargs='+', type=int, default=[10, 50, 100, 200])
+    arg_parser.add_argument('--max_bets', nargs='+', type=int, default=[500, 1000, 2000, 5000, 10000])
+    args = arg_parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    keys = saltydb.TRAINING_FEATURES + ['bias']
+    x = np.column_stack([rng.normal(0, 50, args.fights), rng.randint(-3, 4, args.fights), rng.normal(0, 20, args.fights), np.ones(args.fights)])
+    true_betas = np.array([-0.02, -0.3, -0.03, 0.0])
+    y = (rng.random_sample(args.fights) < 1 / (1 + np.exp(-x @ true_betas))).astype(np.float64)
+    weights = true_betas + rng.normal(0, 0.01, (args.models, len(keys)))
+    sizing = saltybacktest.sizing_grid(args.min_bets, args.max_bets)
+    backtest = saltybacktest.Backtest(weights, sizing)
+
+    n_check = min(2000, args.fights)
+    check = backtest.run(x[:n_check], y[:n_check])
+    for i, j in [(0, 0), (args.models - 1, len(sizing) - 1)]:
+        balance, drawdown = replay(weights[i], x[:n_check], y[:n_check], sizing[j][0], sizing[j][1], backtest.start_balance)
+        assert abs(check['final'][i, j] - balance) < 1e-6 * max(1, abs(balance))
+        assert abs(check['drawdown'][i, j] - drawdown) < 1e-6 * max(1, drawdown)
+
+    start = time.perf_counter()
+    results = backtest.run(x, y, curve_every=1000)
+    elapsed = time.perf_counter() - start
+    print('fights:       %s' % args.fights)
+    print('combinations: %s (%s models x %s sizings)' % (args.models * len(sizing), args.models, len(sizing)))
+    print('backtest:     %.2fs' % elapsed)
+    print('best final balance: %.0f, accuracy range: %.2f-%.2f%%' % (
+        results['final'].max(), results['accuracy'].min(), results['accuracy'].max()
+    ))
+
+
+if __name__ == '__main__':
+    main()
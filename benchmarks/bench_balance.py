@@ -0,0 +1,66 @@
+# Times reading the wallet balance from the homepage with the old BeautifulSoup parse against the streaming
+# BalanceScanner, on a synthetic page.
+# needs benchmarks/requirements.txt for BeautifulSoup.
+# usage: python -m benchmarks.bench_balance [--size 60000] [--position 0.2] [--runs 200]
+from saltybetter.saltyclient import SaltyClient, scan_balance
+from bs4 import BeautifulSoup
+import argparse
+import time
+
+
+def build_page(size, position):
+    filler = '<div class="row"><span class="name">fighter</span><a href="/stats?id=1">stats</a></div>\n'
+    body = filler * (size // len(filler))
+    split = int(len(body) * position)
+    split = body.index('\n', split) + 1 if split < len(body) else split
+    balance = '<input type="hidden" name="b" id="b" value="12345">\n'
+    return ('<!DOCTYPE html>\n<html><head><title>Salty Bet</title></head><body>\n' +
+            body[:split] + balance + body[split:] + '</body></html>\n').encode('utf-8')
+
+
+def bs4_balance(page):
+    clean_html = page.decode('utf-8').strip().strip('<!DOCTYPE html">')
+    soup = BeautifulSoup(clean_html, 'html.parser')
+    return soup.find_all(id='b')[0]['value']
+
+
+def scanner_balance(page, chunk_size):
+    read = [0]
+
+    def chunks():
+        for start in range(0, len(page), chunk_size):
+            read[0] = start + chunk_size
+            yield page[start:start + chunk_size]
+
+    return scan_balance(chunks()), min(read[0], len(page))
+
+
+def timed(fn, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--size', type=int, default=60000, help='Page size in bytes')
+    arg_parser.add_argument('--position', type=float, default=0.2, help='Where the balance input sits in the page, 0-1')
+    arg_parser.add_argument('--runs', type=int, default=200)
+    args = arg_parser.parse_args()
+
+    page = build_page(args.size, args.position)
+    chunk_size = SaltyClient._PAGE_CHUNK_SIZE
+    assert bs4_balance(page) == scanner_balance(page, chunk_size)[0] == '12345'
+
+    bs4_time = timed(lambda: bs4_balance(page), args.runs)
+    scan_time = timed(lambda: scanner_balance(page, chunk_size), args.runs)
+    read = scanner_balance(page, chunk_size)[1]
+    print('page:    %s bytes, balance at %.0f%%' % (len(page), args.position * 100))
+    print('bs4:     %8.1f us, reads %s bytes' % (bs4_time * 1e6, len(page)))
+    print('scanner: %8.1f us, reads %s bytes' % (scan_time * 1e6, read))
+    print('speedup: ~%.0fx' % (bs4_time / scan_time))
+
+
+if __name__ == '__main__':
+    main()
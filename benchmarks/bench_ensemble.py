@@ -0,0 +1,45 @@
+# Times scoring a matchup with every model one LogRegression.p at a time against one ModelEnsemble.p.
+# usage: python -m benchmarks.bench_ensemble [--models 50] [--runs 2000]
+from saltybetter.db import saltydb
+from saltybetter import saltyai
+import argparse
+import random
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--models', type=int, default=50)
+    arg_parser.add_argument('--runs', type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    models = {}
+    ensemble = saltyai.ModelEnsemble()
+    for guid in range(args.models):
+        betas = {key: random.uniform(-0.1, 0.1) for key in saltydb.TRAINING_FEATURES + ['bias']}
+        models[guid] = ensemble[guid] = saltyai.LogRegression(betas)
+    coefficients = {'elo_diff': 12.5, 'wins_diff': -1, 'win_pct_diff': 20.0}
+
+    expected = {guid: model.p(coefficients) for guid, model in models.items()}
+    for guid, prediction in ensemble.p(coefficients).items():
+        assert abs(float(expected[guid]) - prediction) < 1e-9
+
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        for guid, model in models.items():
+            model.p(coefficients)
+    loop = (time.perf_counter() - start) / args.runs
+
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        ensemble.p(coefficients)
+    batched = (time.perf_counter() - start) / args.runs
+
+    print('models:   %s' % args.models)
+    print('per-model: %8.1f us' % (loop * 1e6))
+    print('ensemble:  %8.1f us' % (batched * 1e6))
+    print('speedup:   ~%.0fx' % (loop / batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# Times recomputing every fighter's rating from the full fight history with each rating algorithm,
+# both the in-memory pass alone and SaltyDB.recompute_ratings end to end (read, rate, bulk write).
+# usage: python -m benchmarks.bench_ratings [--fights 1000000] [--fighters 5000]
+from benchmarks.bench_training_data import build_db
+from saltybetter.db import saltydb
+from saltybetter.db import ratings
+from saltybetter.db.replay import FightReplay
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fights', type=int, default=1000000)
+    arg_parser.add_argument('--fighters', type=int, default=5000)
+    args = arg_parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    start = time.perf_counter()
+    build_db(path, args.fights, args.fighters)
+    print('Built %s fights in %.1fs' % (args.fights, time.perf_counter() - start))
+    conn = sqlite3.connect(path)
+    fights = conn.execute('SELECT guid, p1, p2, winner FROM fights ORDER BY time, guid').fetchall()
+    conn.close()
+
+    for name, engine_class in sorted(ratings.RATINGS.items()):
+        engine = engine_class()
+        # the batch pass has to agree with the fight-by-fight one used to rebuild fight_features
+        replay = FightReplay(engine)
+        for _ in replay.replay(fights[:10000]):
+            pass
+        for guid, (rating, deviation) in engine.recompute(fight[1:] for fight in fights[:10000]).items():
+            assert abs(replay.elo[guid] - rating) < 1e-9 and replay.deviation[guid] == deviation
+
+        start = time.perf_counter()
+        engine.recompute(fight[1:] for fight in fights)
+        in_memory = time.perf_counter() - start
+
+        db = saltydb.SaltyDB('sqlite:///%s' % path, ratings=engine)
+        start = time.perf_counter()
+        n_fighters = db.recompute_ratings()
+        total = time.perf_counter() - start
+        print('%-7s in-memory pass %.2fs, recompute_ratings %.2fs (%s fighters)' % (name, in_memory, total, n_fighters))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# End-to-end benchmark of the session pipeline against the local fake server in lockstep mode.
+# Seeds a database with a fight history and a trained model, replays more fights from the same fighters,
+# then reports message-to-bet latency percentiles and fights per second for each session type.
+# usage: python -m benchmarks.bench_session [--fights 200] [--history 20000] [--fighters 500] [--session sync asyncio]
+from saltybetter.db import saltydb
+from saltybetter import saltyai
+from saltybetter import saltyfake
+import argparse
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+
+def seed_db(url, fights):
+    db = saltydb.SaltyDB(url)
+    db.init_db()
+    db.import_fights(fights)
+    model = saltyai.LogRegression(saltydb.TRAINING_FEATURES)
+    model.train_batches(lambda: db.iter_training_batches(), 'winner')
+    db.add_ai_logreg_model(model.to_json())
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def get_stats(port):
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:%s/_stats' % port) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except OSError:
+        return None
+
+
+def run(session, db_url, log_path, port, burst, timeout, extra_args):
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    server = subprocess.Popen([sys.executable, '-m', 'saltybetter', 'fake', log_path, '--lockstep', '--port', str(port), '--burst', str(burst)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = None
+    try:
+        while get_stats(port) is None:
+            time.sleep(0.1)
+        base_url = 'http://127.0.0.1:%s' % port
+        client_args = ['-db', db_url, '--base_url', base_url, '--socket_url', base_url] + extra_args
+        if session == 'asyncio':
+            client_args.append('--asyncio')
+        client = subprocess.Popen([sys.executable, '-m', 'saltybetter'] + client_args,
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + timeout
+        stats = get_stats(port)
+        while not stats['done'] and time.time() < deadline:
+            time.sleep(0.5)
+            stats = get_stats(port)
+        return stats
+    finally:
+        if client is not None:
+            client.send_signal(signal.SIGINT)
+            client.wait()
+        server.terminate()
+        server.wait()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fights', type=int, default=200, help='Fights replayed by the fake server')
+    arg_parser.add_argument('--history', type=int, default=20000, help='Fights in the database before the session starts')
+    arg_parser.add_argument('--fighters', type=int, default=500)
+    arg_parser.add_argument('--session', nargs='+', default=['sync', 'asyncio'], choices=['sync', 'asyncio'])
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--burst', type=int, default=1, help='Socket messages per state change')
+    arg_parser.add_argument('--warmup', type=int, default=20, help='Bets left out of the latencies while the session loads its models')
+    arg_parser.add_argument('--timeout', type=int, default=600, help='Seconds to wait for a replay to finish')
+    args, extra_args = arg_parser.parse_known_args()  # anything else goes to the session, eg. --cache_flush 10
+
+    tmp = tempfile.mkdtemp()
+    fights = saltyfake.random_fights(args.history + args.fights, args.fighters, seed=1)
+    history = list(itertools.islice(fights, args.history))
+    log_path = os.path.join(tmp, 'replay.jsonl')
+    with open(log_path, 'w') as f:
+        for fight in fights:
+            f.write(json.dumps({k: fight[k] for k in ['p1name', 'p2name', 'winner', 'mode']}) + '\n')
+
+    for session in args.session:
+        db_url = 'sqlite:///%s' % os.path.join(tmp, '%s.db' % session)
+        seed_db(db_url, history)
+        stats = run(session, db_url, log_path, args.port, args.burst, args.timeout, extra_args)
+        latencies = [latency * 1000 for latency in stats['latencies'][args.warmup:]]
+        print('%s: %s fights, %s bets' % (session, stats['fights'], stats['bets']))
+        print('  messages: %s, state.json requests: %s (%s not modified)' % (stats['messages'], stats['state_requests'], stats['not_modified']))
+        if stats['elapsed']:
+            print('  throughput: %.1f fights/s' % (stats['fights'] / stats['elapsed']))
+        if latencies:
+            print('  message-to-bet ms (after %s warmup bets): p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % (
+                args.warmup, percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), max(latencies)
+            ))
+
+
+if __name__ == '__main__':
+    main()
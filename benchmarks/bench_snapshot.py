@@ -0,0 +1,54 @@
+# Times warming a full fighter cache from the DB against saving and loading it through a session snapshot,
+# after checking the loaded cache matches the warmed one.
+# usage: python -m benchmarks.bench_snapshot [--fights 1000000] [--fighters 20000] [--cache_size 10000]
+from benchmarks.bench_training_data import build_db
+from saltybetter.db import saltydb
+from saltybetter.db import fightercache
+from saltybetter import saltysnapshot
+import argparse
+import os
+import tempfile
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fights', type=int, default=1000000)
+    arg_parser.add_argument('--fighters', type=int, default=20000)
+    arg_parser.add_argument('--cache_size', type=int, default=10000)
+    args = arg_parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    database = 'sqlite:///%s' % path
+    start = time.perf_counter()
+    build_db(path, args.fights, args.fighters)
+    print('Built %s fights in %.1fs' % (args.fights, time.perf_counter() - start))
+    db = saltydb.SaltyDB(database)
+
+    fighters = fightercache.FighterCache(db, max_fighters=args.cache_size)
+    start = time.perf_counter()
+    fighters.warm()
+    print('warm from DB:  %.3fs' % (time.perf_counter() - start))
+
+    snapshot_path = saltydb.sidecar_path(database, '.snapshot')
+    start = time.perf_counter()
+    saltysnapshot.save(snapshot_path, {
+        'database': database,
+        'rating': 'stake',
+        'high_water': db.get_last_fight_guid(),
+        'models': {},
+        'bet_model_id': None,
+        'session_id': None,
+        'fighters': fighters.dump()
+    })
+    print('save snapshot: %.3fs (%.1f MB)' % (time.perf_counter() - start, os.path.getsize(snapshot_path) / 1e6))
+
+    start = time.perf_counter()
+    loaded = fightercache.FighterCache(db, max_fighters=args.cache_size)
+    loaded.load(saltysnapshot.load(snapshot_path, database, 'stake')['fighters'])
+    print('load snapshot: %.3fs' % (time.perf_counter() - start))
+    assert loaded.dump() == fighters.dump()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Times getting the training data through TrainingCache: building it, bringing it up to date after a few new fights
+# and with none, against reading it all from the DB, after checking the cache matches the DB.
+# usage: python -m benchmarks.bench_training_cache [--fights 1000000] [--fighters 5000] [--new_fights 500]
+from benchmarks.bench_training_data import build_db
+from saltybetter.db import saltydb
+from saltybetter import saltytrain
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import numpy as np
+
+
+# appends n made up fights and their features, as the session would have recorded them
+def add_fights(path, n):
+    conn = sqlite3.connect(path)
+    last = conn.execute('SELECT max(guid) FROM fights').fetchone()[0]
+    conn.executemany('INSERT INTO fights (guid, p1, p2, winner, time, mode) VALUES (?, 1, 2, ?, datetime(\'now\'), \'normal\')',
+                     ((last + i, 1 + i % 2) for i in range(1, n + 1)))
+    conn.executemany('INSERT INTO fight_features (fight, p1elo, p2elo, p1winsvp2, p2winsvp1, p1winpct, p2winpct, winner) '
+                     'VALUES (?, ?, 100, 0, 0, 50, 50, ?)', ((last + i, 100.0 + i, 1 + i % 2) for i in range(1, n + 1)))
+    conn.commit()
+    conn.close()
+
+
+def read_all(db):
+    return sum(len(columns['winner']) for columns in db.iter_training_batches())
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fights', type=int, default=1000000)
+    arg_parser.add_argument('--fighters', type=int, default=5000)
+    arg_parser.add_argument('--new_fights', type=int, default=500)
+    args = arg_parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    start = time.perf_counter()
+    build_db(path, args.fights, args.fighters)
+    db = saltydb.SaltyDB('sqlite:///%s' % path)
+    db.backfill_fight_features()
+    print('Built %s fights in %.1fs' % (args.fights, time.perf_counter() - start))
+    cache = saltytrain.TrainingCache(saltytrain.default_cache_path('sqlite:///%s' % path))
+
+    start = time.perf_counter()
+    rows = read_all(db)
+    print('read from DB:     %s rows in %.2fs' % (rows, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    data = cache.update(db)
+    print('build cache:      %s rows in %.2fs' % (len(data), time.perf_counter() - start))
+
+    add_fights(path, args.new_fights)
+    start = time.perf_counter()
+    data = cache.update(db)
+    print('update, %s new:  %s rows in %.3fs' % (args.new_fights, len(data), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    data = cache.update(db)
+    print('update, none new: %s rows in %.3fs' % (len(data), time.perf_counter() - start))
+
+    expected = np.concatenate([
+        np.column_stack([np.ones(len(columns['winner']))] + [columns[key] for key in saltytrain.COLUMNS[1:]])
+        for columns in db.iter_training_batches()
+    ])
+    assert np.array_equal(np.asarray(data), expected)
+
+    # rewriting cached fights' features has to throw the cache away
+    conn = sqlite3.connect(path)
+    conn.execute('UPDATE fight_features SET p1elo = p1elo + 1 WHERE fight = (SELECT min(fight) FROM fight_features)')
+    conn.commit()
+    conn.close()
+    assert np.array_equal(cache.update(db)[0], expected[0] + [0, 1, 0, 0, 0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Times building and reading the point-in-time training data against the old correlated-subquery query
+# on a synthetic database (without the fights indexes it predates).
+# usage: python -m benchmarks.bench_training_data [--fights 500000] [--fighters 5000] [--legacy_limit 2000]
+from saltybetter.db import saltydb
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+
+# the pre-aggregation query, kept here for comparison. it predates the fights indexes, which are dropped before
+# it's timed, so its cost per row is a scan of fights as it was
+LEGACY_QUERY = '''
+    SELECT p1.elo - p2.elo,
+    (SELECT count(1) FROM fights
+        WHERE (p1 = f.p1 AND p2 = f.p2 AND winner = 1)
+        OR    (p2 = f.p1 AND p1 = f.p2 AND winner = 2)
+    ) - (SELECT count(1) FROM fights
+        WHERE (p1 = f.p2 AND p2 = f.p1 AND winner = 1)
+        OR    (p2 = f.p2 AND p1 = f.p1 AND winner = 2)
+    ),
+    f.winner - 1
+    FROM fights f
+    JOIN fighters p1 ON p1.guid = f.p1
+    JOIN fighters p2 ON p2.guid = f.p2
+    LIMIT ?
+'''
+
+LEGACY_MISSING_INDEXES = ['ix_fights_p1_p2_winner', 'ix_fights_p2_p1_winner']
+
+
+def build_db(path, n_fights, n_fighters):
+    saltydb.SaltyDB('sqlite:///%s' % path).init_db()
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO fighters (guid, name, elo, wins, losses) VALUES (?, ?, ?, ?, ?)', (
+        (i, 'fighter %s' % i, random.uniform(50, 200), random.randint(0, 100), random.randint(0, 100))
+        for i in range(1, n_fighters + 1)
+    ))
+    start = datetime.datetime(2018, 1, 1)
+    conn.executemany('INSERT INTO fights (p1, p2, winner, time, mode) VALUES (?, ?, ?, ?, ?)', (
+        (p1, p2, random.randint(1, 2), str(start + datetime.timedelta(minutes=3 * i)), 'normal')
+        for i, (p1, p2) in enumerate(random.sample(range(1, n_fighters + 1), 2) for _ in range(n_fights))
+    ))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--fights', type=int, default=500000)
+    arg_parser.add_argument('--fighters', type=int, default=5000)
+    arg_parser.add_argument('--legacy_limit', type=int, default=2000, help='Rows of the legacy query to time. The total is extrapolated.')
+    args = arg_parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    start = time.perf_counter()
+    build_db(path, args.fights, args.fighters)
+    print('Built %s fights in %.1fs' % (args.fights, time.perf_counter() - start))
+
+    db = saltydb.SaltyDB('sqlite:///%s' % path)
+    start = time.perf_counter()
+    db.backfill_fight_features()
+    backfill = time.perf_counter() - start
+    print('backfill:   %.2fs' % backfill)
+
+    start = time.perf_counter()
+    rows = db.get_training_data()
+    scan = time.perf_counter() - start
+    print('scan:       %s rows in %.2fs' % (len(rows), scan))
+
+    conn = sqlite3.connect(path)
+    for index in LEGACY_MISSING_INDEXES:
+        conn.execute('DROP INDEX %s' % index)
+    start = time.perf_counter()
+    conn.execute(LEGACY_QUERY, (args.legacy_limit,)).fetchall()
+    legacy = time.perf_counter() - start
+    legacy_total = legacy / args.legacy_limit * args.fights
+    print('legacy:     %s rows in %.2fs (~%.0fs extrapolated for %s rows)' % (args.legacy_limit, legacy, legacy_total, args.fights))
+    print('speedup:    ~%.0fx (backfill + scan), ~%.0fx (scan)' % (legacy_total / (backfill + scan), legacy_total / scan))
+
+
+if __name__ == '__main__':
+    main()
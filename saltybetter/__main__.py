@@ -1,8 +1,16 @@
 from . import saltysession
+from . import saltycommands
+import sys
 
 
 def main():
-    saltysession.SaltySession().start()
+    if len(sys.argv) > 1 and sys.argv[1] in saltycommands.COMMANDS:
+        saltycommands.COMMANDS[sys.argv[1]](sys.argv[2:])
+    elif '--asyncio' in sys.argv:
+        from . import saltyasync  # needs aiohttp
+        saltyasync.AsyncSaltySession().start()
+    else:
+        saltysession.SaltySession().start()
 
 
 if __name__ == '__main__':
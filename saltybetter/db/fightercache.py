@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CachedFighter:
+    __slots__ = ['guid', 'name', 'elo', 'deviation', 'wins', 'losses', 'h2h']
+
+    def __init__(self, guid, name, elo, deviation, wins, losses):
+        self.guid = guid
+        self.name = name
+        self.elo = elo
+        self.deviation = deviation
+        self.wins = wins
+        self.losses = losses
+        self.h2h = {}  # opponent guid -> wins against them
+
+    @classmethod
+    def from_row(cls, fighter):
+        return cls(fighter.guid, fighter.name, fighter.elo, fighter.deviation, fighter.wins, fighter.losses)
+
+    @property
+    def winpct(self):
+        if self.wins + self.losses == 0:
+            return 50.0
+        return float(self.wins) / (self.wins + self.losses) * 100
+
+    def __repr__(self):
+        return '<CachedFighter ({guid}): {name}>'.format(
+            guid = self.guid,
+            name = self.name
+        )
+
+
+# Process-local cache of fighter stats and head-to-head wins for the betting hot path.
+# Fights are applied in place and written through to the DB in batches of flush_every.
+# Holds at most max_fighters, evicting the least recently used.
+class FighterCache:
+
+    def __init__(self, db, max_fighters=10000, flush_every=10):
+        self.db = db
+        self.max_fighters = max_fighters
+        self.flush_every = flush_every
+        self._fighters = OrderedDict()  # guid -> CachedFighter, least recently used first
+        self._names = {}  # name -> guid
+        self._pending = []  # fights not yet written to the DB
+        self._dirty = {}  # guid -> CachedFighter with stats not yet written to the DB
+
+    # loads the most recently active fighters and their head-to-head wins
+    def warm(self):
+        for fighter in reversed(self.db.get_recent_fighters(self.max_fighters)):
+            self._put(CachedFighter.from_row(fighter))
+        for winner, loser, wins in self.db.get_head_to_head():
+            if winner in self._fighters:
+                self._fighters[winner].h2h[loser] = wins
+        log.info('Fighter cache warmed: %s fighters' % len(self._fighters))
+
+    # the cached fighters, least recently used first, as plain values for a snapshot. flush first
+    def dump(self):
+        return [(f.guid, f.name, f.elo, f.deviation, f.wins, f.losses, f.h2h) for f in self._fighters.values()]
+
+    # fills the cache from dump() instead of warming it from the DB
+    def load(self, fighters):
+        for guid, name, elo, deviation, wins, losses, h2h in fighters:
+            fighter = CachedFighter(guid, name, elo, deviation, wins, losses)
+            fighter.h2h = h2h
+            self._put(fighter)
+        log.info('Fighter cache loaded: %s fighters' % len(self._fighters))
+
+    # drops a fighter whose cached stats can't be trusted. it's reloaded from the DB when next needed
+    def discard(self, name):
+        guid = self._names.pop(name, None)
+        if guid is not None:
+            del self._fighters[guid]
+
+    def get_or_add_fighter(self, name):
+        guid = self._names.get(name)
+        if guid is not None:
+            self._fighters.move_to_end(guid)
+            return self._fighters[guid]
+
+        self.flush()  # so an evicted fighter is never reloaded with stale stats
+        fighter = CachedFighter.from_row(self.db.get_or_add_fighter(name))
+        for _, loser, wins in self.db.get_head_to_head(fighter.guid):
+            fighter.h2h[loser] = wins
+        self._put(fighter)
+        return fighter
+
+    # same shape as SaltyDB.get_matchup_stats. every fight is a win or a loss, so those are the fight counts
+    def get_matchup_stats(self, p1, p2):
+        return {
+            'p1_wins': p1.h2h.get(p2.guid, 0),
+            'p2_wins': p2.h2h.get(p1.guid, 0),
+            'p1_fights': p1.wins + p1.losses,
+            'p2_fights': p2.wins + p2.losses
+        }
+
+    # bets: the fight's rows for the bets ledger, written with it (see SaltyDB.add_bets)
+    def add_fight(self, p1name, p2name, winner, mode, bets=None):
+        if p1name == p2name:
+            log.warning('Self fight detected. Ignoring. %s' % p1name)
+            return
+
+        p1 = self.get_or_add_fighter(p1name)
+        p2 = self.get_or_add_fighter(p2name)
+        features = {
+            'p1elo': p1.elo,
+            'p2elo': p2.elo,
+            'p1winpct': p1.winpct,
+            'p2winpct': p2.winpct,
+            'p1winsvp2': p1.h2h.get(p2.guid, 0),
+            'p2winsvp1': p2.h2h.get(p1.guid, 0),
+            'winner': winner
+        }
+
+        if winner == 1:
+            winner_fighter, loser_fighter = p1, p2
+        elif winner == 2:
+            winner_fighter, loser_fighter = p2, p1
+        else:
+            raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
+        (winner_fighter.elo, winner_fighter.deviation), (loser_fighter.elo, loser_fighter.deviation) = self.db.ratings.rate(
+            (winner_fighter.elo, winner_fighter.deviation), (loser_fighter.elo, loser_fighter.deviation)
+        )
+        winner_fighter.wins += 1
+        winner_fighter.h2h[loser_fighter.guid] = winner_fighter.h2h.get(loser_fighter.guid, 0) + 1
+        loser_fighter.losses += 1
+
+        self._pending.append({
+            'p1': p1.guid,
+            'p2': p2.guid,
+            'winner': winner,
+            'mode': mode,
+            'time': datetime.datetime.utcnow(),
+            'features': features,
+            'bets': bets or []
+        })
+        self._dirty[p1.guid] = p1
+        self._dirty[p2.guid] = p2
+        log.info('Fight cached %s vs. %s, winner: %s' % (p1, p2, winner))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    # writes pending fights and fighter stats to the DB
+    def flush(self):
+        if not self._pending:
+            return
+        self.db.add_fights_bulk(self._pending, [{
+            'guid': fighter.guid,
+            'elo': fighter.elo,
+            'deviation': fighter.deviation,
+            'wins': fighter.wins,
+            'losses': fighter.losses
+        } for fighter in self._dirty.values()])
+        self._pending = []
+        self._dirty = {}
+
+    def _put(self, fighter):
+        self._fighters[fighter.guid] = fighter
+        self._fighters.move_to_end(fighter.guid)
+        self._names[fighter.name] = fighter.guid
+        while len(self._fighters) > self.max_fighters:
+            evicted = self._fighters.pop(next(iter(self._fighters)))
+            del self._names[evicted.name]
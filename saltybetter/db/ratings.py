@@ -0,0 +1,93 @@
+from abc import ABC, abstractmethod
+import math
+
+
+# Rating algorithms for fighters. A rating is (rating, deviation); the rating is what's stored in Fighter.elo,
+# the deviation is only used by algorithms that track uncertainty and is None for the others.
+# SaltyDB, FighterCache and FightReplay all rate fights through one of these, so live updates and
+# recomputing the whole history agree.
+class RatingEngine(ABC):
+    start_rating = 100.0
+    start_deviation = None
+
+    # returns the new (winner, loser) ratings
+    @abstractmethod
+    def rate(self, winner, loser):
+        pass
+
+    # rates every fight in order. fights: iterable of (p1, p2, winner) with winner 1 or 2.
+    # returns {guid: (rating, deviation)} for every fighter that fought
+    def recompute(self, fights):
+        ratings = {}
+        start = (self.start_rating, self.start_deviation)
+        rate = self.rate
+        for p1, p2, winner in fights:
+            p1rating = ratings.get(p1, start)
+            p2rating = ratings.get(p2, start)
+            if winner == 1:
+                ratings[p1], ratings[p2] = rate(p1rating, p2rating)
+            elif winner == 2:
+                ratings[p2], ratings[p1] = rate(p2rating, p1rating)
+            else:
+                raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
+        return ratings
+
+
+# the original rule: the winner takes stake times the loser's rating from the loser
+class StakeRating(RatingEngine):
+
+    def __init__(self, stake=0.05):
+        self.stake = stake
+
+    def rate(self, winner, loser):
+        won = self.stake * loser[0]
+        return (winner[0] + won, winner[1]), (loser[0] - won, loser[1])
+
+
+# https://en.wikipedia.org/wiki/Elo_rating_system
+class EloRating(RatingEngine):
+
+    def __init__(self, k=32.0, scale=400.0):
+        self.k = k
+        self.scale = scale
+
+    def rate(self, winner, loser):
+        won = self.k / (1.0 + 10.0 ** ((winner[0] - loser[0]) / self.scale))  # k times the chance the winner had of losing
+        return (winner[0] + won, winner[1]), (loser[0] - won, loser[1])
+
+
+# Glicko-1, http://www.glicko.net/glicko/glicko.pdf, with every fight its own rating period.
+# drift: deviation added before each fight, so fighters who haven't been seen for a while (in fights) can move again
+class GlickoRating(RatingEngine):
+    start_deviation = 350.0
+    _Q = math.log(10) / 400
+
+    def __init__(self, drift=15.0, min_deviation=30.0):
+        self.drift = drift
+        self.min_deviation = min_deviation
+
+    def rate(self, winner, loser):
+        # both sides of the update, inlined since this runs for every fight of a recompute
+        q, start, drift, pi2 = self._Q, self.start_deviation, self.drift, math.pi ** 2
+        winner_deviation = min(math.sqrt((winner[1] or start) ** 2 + drift ** 2), start)
+        loser_deviation = min(math.sqrt((loser[1] or start) ** 2 + drift ** 2), start)
+        # g of each opponent's deviation (from before the drift), and the winner's expected score
+        g_winner = 1.0 / math.sqrt(1.0 + 3.0 * (q * (loser[1] or start)) ** 2 / pi2)
+        g_loser = 1.0 / math.sqrt(1.0 + 3.0 * (q * (winner[1] or start)) ** 2 / pi2)
+        diff = winner[0] - loser[0]
+        winner_expected = 1.0 / (1.0 + 10.0 ** (-g_winner * diff / 400))
+        loser_expected = 1.0 / (1.0 + 10.0 ** (g_loser * diff / 400))
+
+        winner_variance = 1.0 / (1.0 / winner_deviation ** 2 + q * q * g_winner * g_winner * winner_expected * (1 - winner_expected))
+        loser_variance = 1.0 / (1.0 / loser_deviation ** 2 + q * q * g_loser * g_loser * loser_expected * (1 - loser_expected))
+        return (
+            (winner[0] + q * winner_variance * g_winner * (1.0 - winner_expected), max(math.sqrt(winner_variance), self.min_deviation)),
+            (loser[0] - q * loser_variance * g_loser * loser_expected, max(math.sqrt(loser_variance), self.min_deviation))
+        )
+
+
+RATINGS = {
+    'stake': StakeRating,
+    'elo': EloRating,
+    'glicko': GlickoRating
+}
@@ -0,0 +1,97 @@
+from .ratings import StakeRating
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# In-memory replay of the fight history. Tracks ratings, wins, losses and head-to-head wins per fighter guid
+# using the same rules as SaltyDB.add_fight, so the pre-fight features of any fight can be rebuilt
+# without touching the DB.
+# ratings: the RatingEngine to rate fights with
+class FightReplay:
+    COLUMNS = ['fight', 'p1elo', 'p2elo', 'p1winpct', 'p2winpct', 'p1winsvp2', 'p2winsvp1', 'winner']
+
+    def __init__(self, ratings=None):
+        self.ratings = ratings or StakeRating()
+        self.start_elo = self.ratings.start_rating
+        self.elo = {}
+        self.deviation = {}
+        self.wins = {}
+        self.losses = {}
+        self.h2h = {}  # (winner guid, loser guid) -> wins
+
+    def winpct(self, guid):
+        wins = self.wins.get(guid, 0)
+        losses = self.losses.get(guid, 0)
+        if wins + losses == 0:
+            return 50.0
+        return float(wins) / (wins + losses) * 100
+
+    # current stats for the matchup, in the shape of a fight_features row
+    def features(self, p1, p2):
+        return {
+            'p1elo': self.elo.get(p1, self.start_elo),
+            'p2elo': self.elo.get(p2, self.start_elo),
+            'p1winpct': self.winpct(p1),
+            'p2winpct': self.winpct(p2),
+            'p1winsvp2': self.h2h.get((p1, p2), 0),
+            'p2winsvp1': self.h2h.get((p2, p1), 0)
+        }
+
+    # applies a fight result. returns the pre-fight features
+    def record(self, p1, p2, winner):
+        features = self.features(p1, p2)
+        if winner == 1:
+            winner_guid, loser_guid = p1, p2
+        elif winner == 2:
+            winner_guid, loser_guid = p2, p1
+        else:
+            raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
+
+        winner_rating, loser_rating = self.ratings.rate(self._rating(winner_guid), self._rating(loser_guid))
+        self.elo[winner_guid], self.deviation[winner_guid] = winner_rating
+        self.elo[loser_guid], self.deviation[loser_guid] = loser_rating
+        self.wins[winner_guid] = self.wins.get(winner_guid, 0) + 1
+        self.losses[loser_guid] = self.losses.get(loser_guid, 0) + 1
+        self.h2h[(winner_guid, loser_guid)] = self.h2h.get((winner_guid, loser_guid), 0) + 1
+        return features
+
+    def _rating(self, guid):
+        return self.elo.get(guid, self.start_elo), self.deviation.get(guid, self.ratings.start_deviation)
+
+    # fights: iterable of (guid, p1, p2, winner) in time order
+    # yields a tuple of fight_features values, ordered as COLUMNS, for each fight.
+    # same as calling record for every fight, inlined since this runs over the whole history
+    def replay(self, fights):
+        elo, deviation, wins, losses, h2h = self.elo, self.deviation, self.wins, self.losses, self.h2h
+        rate, start, start_deviation = self.ratings.rate, self.start_elo, self.ratings.start_deviation
+        for guid, p1, p2, winner in fights:
+            p1elo = elo.get(p1, start)
+            p2elo = elo.get(p2, start)
+            p1wins = wins.get(p1, 0)
+            p2wins = wins.get(p2, 0)
+            p1fights = p1wins + losses.get(p1, 0)
+            p2fights = p2wins + losses.get(p2, 0)
+            p1winsvp2 = h2h.get((p1, p2), 0)
+            p2winsvp1 = h2h.get((p2, p1), 0)
+            yield (
+                guid, p1elo, p2elo,
+                50.0 if p1fights == 0 else float(p1wins) / p1fights * 100,
+                50.0 if p2fights == 0 else float(p2wins) / p2fights * 100,
+                p1winsvp2, p2winsvp1, winner
+            )
+
+            p1rating = (p1elo, deviation.get(p1, start_deviation))
+            p2rating = (p2elo, deviation.get(p2, start_deviation))
+            if winner == 1:
+                (elo[p1], deviation[p1]), (elo[p2], deviation[p2]) = rate(p1rating, p2rating)
+                wins[p1] = p1wins + 1
+                losses[p2] = losses.get(p2, 0) + 1
+                h2h[(p1, p2)] = p1winsvp2 + 1
+            elif winner == 2:
+                (elo[p2], deviation[p2]), (elo[p1], deviation[p1]) = rate(p2rating, p1rating)
+                wins[p2] = p2wins + 1
+                losses[p1] = losses.get(p1, 0) + 1
+                h2h[(p2, p1)] = p2winsvp1 + 1
+            else:
+                raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
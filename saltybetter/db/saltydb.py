@@ -1,15 +1,33 @@
-from sqlalchemy import create_engine, desc, case, cast, func, or_, and_, Column, ForeignKey
-from sqlalchemy import String, Integer, Float, DateTime, Boolean
+from sqlalchemy import create_engine, event, inspect, select, bindparam, text, desc, case, cast, func, or_, and_, Column, ForeignKey, Index
+from sqlalchemy import String, Integer, BigInteger, Float, DateTime, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from contextlib import contextmanager
+from .replay import FightReplay
+from .ratings import StakeRating
+import numpy as np
 import logging
+import threading
 import datetime
+import csv
+import io
 
 
 log = logging.getLogger(__name__)
 Base = declarative_base()
 
+TRAINING_FEATURES = ['elo_diff', 'wins_diff', 'win_pct_diff']
+
+_CHECKSUM_SCALE = 1000000  # elo_diff is checksummed in millionths, truncated, so both sides sum exact integers
+
+_engines = {}  # (conn_str, echo) -> (engine, scoped session factory), shared by every SaltyDB in the process
+_engines_lock = threading.Lock()
+_best_models = {}  # (conn_str, min_bets) -> (guid, has min_bets, won_bets_pct) of the best model, shared the same way
+_best_models_lock = threading.Lock()
+
 
 # https://www.blog.pythonlibrary.org/2010/09/10/sqlalchemy-connecting-to-pre-existing-databases/
 # http://docs.sqlalchemy.org/en/latest/core/reflection.html
@@ -18,77 +36,420 @@ Base = declarative_base()
 
 
 # noinspection PyPep8
+# Cheap to create: every SaltyDB on the same database shares one engine and connection pool per process,
+# and each thread gets its own session from it. Tables are only created by init_db.
 class SaltyDB:
+    _POOL_SIZE = 5
+    _MAX_OVERFLOW = 10
+    _POOL_RECYCLE = 3600  # seconds before a pooled connection is replaced, so servers can't time it out under us
 
-    def __init__(self, conn_str, elo_stake=0.05, echo=False):
+    # ratings: the RatingEngine fights are rated with. defaults to the original rule with elo_stake
+    def __init__(self, conn_str, elo_stake=0.05, echo=False, ratings=None):
+        self.conn_str = conn_str
         self.elo_stake = elo_stake
-        self.engine = create_engine(conn_str, echo=echo)
+        self.ratings = ratings or StakeRating(elo_stake)
+        self.engine, self._sessions = self._connect(conn_str, echo)
+
+    @classmethod
+    def _connect(cls, conn_str, echo):
+        with _engines_lock:
+            if (conn_str, echo) not in _engines:
+                engine = cls._create_engine(conn_str, echo)
+                _engines[(conn_str, echo)] = (engine, scoped_session(sessionmaker(bind=engine)))
+            return _engines[(conn_str, echo)]
+
+    # sqlite connections are shared across threads through the pool, an in-memory database through its one connection
+    @classmethod
+    def _create_engine(cls, conn_str, echo):
+        url = make_url(conn_str)
+        if url.get_backend_name() != 'sqlite':
+            return create_engine(conn_str, echo=echo, pool_size=cls._POOL_SIZE, max_overflow=cls._MAX_OVERFLOW,
+                                 pool_recycle=cls._POOL_RECYCLE, pool_pre_ping=True)
+        if url.database in [None, '', ':memory:']:
+            return create_engine(conn_str, echo=echo, poolclass=StaticPool, connect_args={'check_same_thread': False})
+        engine = create_engine(conn_str, echo=echo, poolclass=QueuePool, pool_size=cls._POOL_SIZE, max_overflow=cls._MAX_OVERFLOW,
+                               connect_args={'check_same_thread': False})
+        event.listen(engine, 'connect', _sqlite_wal)
+        return engine
+
+    # this thread's session
+    @property
+    def session(self):
+        return self._sessions()
+
+    # closes this thread's session, handing its connection back to the pool. the next use starts a new one
+    def close(self):
+        self._sessions.remove()
+
+    # groups every write made inside the block into one commit. rolls all of them back if the block raises.
+    # nests, only the outermost block commits. the depth is kept on the thread's session, which other SaltyDBs share
+    @contextmanager
+    def unit_of_work(self):
+        session = self.session
+        session.info['uow_depth'] = session.info.get('uow_depth', 0) + 1
+        try:
+            yield self
+            if session.info['uow_depth'] == 1:
+                session.commit()
+        except:
+            if session.info['uow_depth'] == 1:
+                session.rollback()
+                forget_best_models(self.conn_str)  # may have been updated from rolled back bets
+            raise
+        finally:
+            session.info['uow_depth'] -= 1
+
+    # commits, unless inside a unit of work. then just flushes so new rows get their guids
+    def _commit(self):
+        if self.session.info.get('uow_depth'):
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    # creates missing tables, then any columns and indexes missing from tables that already existed
+    def init_db(self):
+        inspector = inspect(self.engine)
+        # bets was never written to before it became the ledger. an empty one from then is recreated
+        if 'bets' in inspector.get_table_names() and 'model' not in {column['name'] for column in inspector.get_columns('bets')}:
+            if self.session.query(func.count(Bet.guid)).scalar() == 0:
+                self.session.rollback()
+                Bet.__table__.drop(self.engine)
+                log.info('Recreating the empty bets table as the bets ledger')
         Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    self._add_column(table, column)
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+                    log.info('Created index %s' % index.name)
+
+    # adds a column to an existing table, filled in with its default if that is a constant.
+    # won_bets_pct is computed from the counts
+    def _add_column(self, table, column):
+        default = ' DEFAULT %s' % column.default.arg if column.default is not None and column.default.is_scalar else ''
+        with self.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s%s' % (
+                table.name, column.name, column.type.compile(self.engine.dialect), default
+            )))
+            if table is AILogregModel.__table__ and column.name == 'won_bets_pct':
+                models = AILogregModel.__table__
+                conn.execute(models.update().values(won_bets_pct=case(
+                    [(models.c.won_bets + models.c.lost_bets == 0, 0.0)],
+                    else_=cast(models.c.won_bets, Float) / (models.c.won_bets + models.c.lost_bets) * 100.0
+                )))
+        log.info('Added column %s.%s' % (table.name, column.name))
+
+    # query plans for the queries run while betting and training. returns {name: [plan lines]}
+    def explain_hot_queries(self, guid=1):
+        queries = {
+            'get_fighter_by_name': self.session.query(Fighter).filter(Fighter.name == 'name'),
+            'get_fights': self.session.query(Fight).filter(or_(Fight.p1 == guid, Fight.p2 == guid)),
+            'get_wins_against': self.session.query(Fight).filter(or_(
+                and_(Fight.p1 == guid, Fight.p2 == guid + 1, Fight.winner == 1),
+                and_(Fight.p1 == guid + 1, Fight.p2 == guid, Fight.winner == 2)
+            )),
+            'backfill_fight_features': self._fights_in_order(),
+            'get_matchup_stats': self._matchup_query(guid, guid + 1),
+            'get_best_logreg_model': self._best_model_query(400),
+        }
+        explain = 'EXPLAIN QUERY PLAN ' if self.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        plans = {}
+        for name, query in queries.items():
+            sql = str(getattr(query, 'statement', query).compile(dialect=self.engine.dialect, compile_kwargs={'literal_binds': True}))
+            plans[name] = [str(row[-1]) for row in self.session.execute(text(explain + sql))]
+        return plans
 
     def add_ai_logreg_model(self, serialized):
         new_model = AILogregModel(betas=serialized)
         self.session.add(new_model)
-        self.session.commit()
+        self._commit()
+        self._update_best_models(new_model)
         log.info('Saved LogReg model: %s' % new_model)
         return new_model  # this might have issues with threads
 
-    def get_best_logreg_model(self, min_bets=0):
+    # checkpoints models trained online. betas: {model guid: serialized betas}, all written in one commit
+    def update_logreg_models(self, betas):
+        self.session.bulk_update_mappings(AILogregModel, [{'guid': guid, 'betas': serialized} for guid, serialized in betas.items()])
+        self._commit()
+        log.info('Checkpointed LogReg models: %s' % list(betas.keys()))
+
+    # guids: only these models. all of them if None
+    def get_logreg_models(self, guids=None):
         q = self.session.query(AILogregModel)
-        q = q.filter(AILogregModel.won_bets + AILogregModel.lost_bets >= min_bets)
-        q = q.order_by(desc(AILogregModel.won_bets_pct))
-        return q.first()
+        if guids is not None:
+            q = q.filter(AILogregModel.guid.in_(guids))
+        return q.order_by(AILogregModel.guid).all()
 
-    def add_fight(self, p1name, p2name, winner, mode):
+    # the model with the best win rate among those with at least min_bets bets, or among all of them if none has
+    # that many. None if there are no models. the ranking is read off the won_bets_pct index once per min_bets and
+    # database in the process, then kept up to date by add_bets and add_ai_logreg_model on any SaltyDB
+    def get_best_logreg_model(self, min_bets=0):
+        key = (self.conn_str, min_bets)
+        with _best_models_lock:
+            best = _best_models.get(key)
+        if best is None:
+            row = self._best_model_query(min_bets).first()
+            if row is None:
+                row = self._best_model_query(None).first()  # none has min_bets bets, the best of them all
+            if row is None:
+                return None
+            best = (row.guid, row.won_bets + row.lost_bets >= min_bets, row.won_bets_pct)
+            with _best_models_lock:
+                _best_models.setdefault(key, best)
+        return self.session.query(AILogregModel).get(best[0])
+
+    # walks the won_bets_pct index from the top, the counts in it cover the min_bets filter. min_bets None: no filter
+    def _best_model_query(self, min_bets):
+        m = AILogregModel
+        q = self.session.query(m.guid, m.won_bets, m.lost_bets, m.won_bets_pct)
+        if min_bets is not None:
+            q = q.filter(m.won_bets + m.lost_bets >= min_bets)
+        return q.order_by(desc(m.won_bets_pct)).limit(1)
+
+    # updates the cached best models with one model's new record instead of ranking them all again
+    def _update_best_models(self, model):
+        n_bets = model.won_bets + model.lost_bets
+        with _best_models_lock:
+            for (conn_str, min_bets), best in list(_best_models.items()):
+                if conn_str != self.conn_str:
+                    continue
+                rank = (model.guid, n_bets >= min_bets, model.won_bets_pct)
+                if best[0] == model.guid:
+                    if rank[1:] < best[1:]:  # dropped, another model may be ahead now
+                        del _best_models[(conn_str, min_bets)]
+                    else:
+                        _best_models[(conn_str, min_bets)] = rank
+                elif rank[1:] > best[1:]:
+                    _best_models[(conn_str, min_bets)] = rank
+
+    # bets: the fight's rows for the bets ledger, see add_bets
+    def add_fight(self, p1name, p2name, winner, mode, bets=None):
         if p1name == p2name:
             log.warning('Self fight detected. Ignoring. %s' % p1name)
             return
 
-        p1 = self.get_or_add_fighter(p1name)
-        p2 = self.get_or_add_fighter(p2name)
-
-        if winner == 1:
-            self.increment_wins(p1.guid, p2.elo if p2 else 0)
-            self.increment_losses(p2.guid)
-        elif winner == 2:
-            self.increment_losses(p1.guid)
-            self.increment_wins(p2.guid, p1.elo if p1 else 0)
+        with self.unit_of_work():
+            p1 = self.get_or_add_fighter(p1name)
+            p2 = self.get_or_add_fighter(p2name)
+            # point-in-time features, captured before the rating and win/loss updates below
+            matchup = self.get_matchup_stats(p1.guid, p2.guid)
+            features = FightFeatures(
+                p1elo=p1.elo,
+                p2elo=p2.elo,
+                p1winpct=p1.winpct,
+                p2winpct=p2.winpct,
+                p1winsvp2=matchup['p1_wins'],
+                p2winsvp1=matchup['p2_wins'],
+                winner=winner
+            )
+
+            if winner == 1:
+                self._record_result(p1, p2)
+            elif winner == 2:
+                self._record_result(p2, p1)
+            else:
+                raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
+
+            new_fight = Fight(p1=p1.guid, p2=p2.guid, winner=winner, mode=mode)
+            self.session.add(new_fight)
+            self.session.flush()
+            features.fight = new_fight.guid
+            self.session.add(features)
+            self.add_bets([dict(bet, fight=new_fight.guid) for bet in bets or []])
+            log.info('Fight recorded %s' % new_fight)
+            return new_fight.guid  # TODO: return whole fight
+
+    # every fight, oldest first, as the backfill replays them
+    def _fights_in_order(self):
+        return select([Fight.guid, Fight.p1, Fight.p2, Fight.winner]).order_by(Fight.time, Fight.guid)
+
+    # rebuilds fight_features from scratch by replaying every fight in time order
+    # update_fighters: also overwrite every fighter's elo, wins and losses with the replayed values
+    def backfill_fight_features(self, batch_size=10000, update_fighters=False):
+        log.info('Backfilling fight features, this may take a while...')
+        self.session.query(FightFeatures).delete()
+        fights = self.session.connection().execution_options(stream_results=True).execute(self._fights_in_order())
+        replay = FightReplay(self.ratings)
+        features = replay.replay(row for rows in iter(lambda: fights.fetchmany(batch_size), []) for row in rows)
+        n = 0
+        while True:
+            batch = [f for _, f in zip(range(batch_size), features)]
+            if not batch:
+                break
+            self._bulk_insert(FightFeatures.__table__, FightReplay.COLUMNS, batch)
+            n += len(batch)
+
+        if update_fighters:
+            self.session.query(Fighter).update({
+                Fighter.elo: replay.start_elo,
+                Fighter.deviation: self.ratings.start_deviation,
+                Fighter.wins: 0,
+                Fighter.losses: 0
+            }, synchronize_session=False)
+            self.session.bulk_update_mappings(Fighter, [{
+                'guid': guid,
+                'elo': elo,
+                'deviation': replay.deviation[guid],
+                'wins': replay.wins.get(guid, 0),
+                'losses': replay.losses.get(guid, 0)
+            } for guid, elo in replay.elo.items()])
+            log.info('Fighters updated: %s' % len(replay.elo))
+        self._commit()
+        log.info('Fight features backfilled: %s' % n)
+        return n
+
+    # bulk loads a fight log, then replays the whole history to recompute fighter stats and fight_features
+    # fights: iterable of dicts with p1name, p2name, winner (1 or 2), and optional mode and time
+    def import_fights(self, fights, batch_size=10000):
+        imported = datetime.datetime.utcnow()  # fights without a time keep their file order through guid
+        rows = []
+        names = set()
+        for fight in fights:
+            if fight['p1name'] == fight['p2name']:
+                log.warning('Self fight detected. Ignoring. %s' % fight['p1name'])
+                continue
+            if fight['winner'] not in [1, 2]:
+                raise RuntimeError("Winner must be in [1, 2]: %s" % fight['winner'])
+            rows.append(fight)
+            names.update([fight['p1name'], fight['p2name']])
+
+        with self.unit_of_work():
+            # rebuilding the fights indexes once is cheaper than updating them for every row of a big import
+            rebuild_indexes = len(rows) > self.session.query(func.count(Fight.guid)).scalar()
+            if rebuild_indexes:
+                for index in Fight.__table__.indexes:
+                    index.drop(self.session.connection())
+
+            guids = dict(self.session.query(Fighter.name, Fighter.guid))
+            new_names = [{'name': name} for name in names if name not in guids]
+            if new_names:
+                self.session.execute(Fighter.__table__.insert(), new_names)
+                guids = dict(self.session.query(Fighter.name, Fighter.guid))
+            log.info('Fighters added: %s' % len(new_names))
+
+            for start in range(0, len(rows), batch_size):
+                self._bulk_insert(Fight.__table__, ['p1', 'p2', 'winner', 'time', 'mode'], [(
+                    guids[fight['p1name']],
+                    guids[fight['p2name']],
+                    fight['winner'],
+                    fight.get('time') or imported,
+                    fight.get('mode')
+                ) for fight in rows[start:start + batch_size]])
+            log.info('Fights imported: %s' % len(rows))
+            if rebuild_indexes:
+                for index in Fight.__table__.indexes:
+                    index.create(self.session.connection())
+
+            self.backfill_fight_features(batch_size=batch_size, update_fighters=True)
+        return len(rows)
+
+    # inserts tuples of column values straight through the DBAPI cursor, skipping per-row SQLAlchemy processing.
+    # uses COPY on postgres, executemany everywhere else. python-side column defaults are not applied,
+    # so pass every column that has one.
+    def _bulk_insert(self, table, columns, rows):
+        if not rows:
+            return
+        cursor = self.session.connection().connection.cursor()
+        if self.engine.dialect.name == 'postgresql':
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (table.name, ', '.join(columns)), buf)
         else:
-            raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
-
-        new_fight = Fight(p1=p1.guid, p2=p2.guid, winner=winner, mode=mode)
-        self.session.add(new_fight)
-        self.session.commit()
-        log.info('Fight recorded %s' % new_fight)
-        return new_fight.guid  # TODO: return whole fight
-
-    # TODO: refactor to not need this - just keep the session object and update
-    def increment_session_wins(self, session_guid):
-        session = self.session.query(Session).filter(Session.guid == session_guid).first()
-        session.won_bets += 1
-        self.session.commit()
-
-    def increment_model_wins(self, model_guid):
-        model = self.session.query(AILogregModel).filter(AILogregModel.guid == model_guid).first()
-        model.won_bets += 1
-        self.session.commit()
-
-    def increment_session_losses(self, session_guid):
-        session = self.session.query(Session).filter(Session.guid == session_guid).first()
-        session.lost_bets += 1
-        self.session.commit()
-
-    def increment_model_losses(self, model_guid):
-        model = self.session.query(AILogregModel).filter(AILogregModel.guid == model_guid).first()
-        model.lost_bets += 1
-        self.session.commit()
+            # the type conversions SQLAlchemy would have done, e.g. datetimes to its sqlite string format
+            processors = [table.c[c].type.dialect_impl(self.engine.dialect).bind_processor(self.engine.dialect) for c in columns]
+            if any(processors):
+                values = list(zip(*rows))
+                for i, processor in enumerate(processors):
+                    if processor is not None:
+                        values[i] = [None if v is None else processor(v) for v in values[i]]
+                rows = list(zip(*values))
+            insert = table.insert().values({c: bindparam(c) for c in columns}).compile(dialect=self.engine.dialect)
+            if self.engine.dialect.positional:
+                order = [insert.positiontup.index(c) for c in columns]
+                rows = [tuple(row[i] for i in order) for row in rows] if order != list(range(len(columns))) else rows
+            else:
+                rows = [dict(zip(columns, row)) for row in rows]
+            cursor.executemany(str(insert), rows)
+        cursor.close()
+
+    # records bets in the ledger with one multi-row insert, then adds them to the won/lost counters of their models
+    # and sessions, one UPDATE per table. bets: dicts of every Bet column but guid. amount, pre_balance and profit
+    # are None for picks that weren't wagered, which don't count towards their session
+    def add_bets(self, bets):
+        if not bets:
+            return
+        self.session.execute(Bet.__table__.insert().values(bets))
+        counts = {AILogregModel: {}, Session: {}}
+        for bet in bets:
+            keys = [(AILogregModel, bet['model'])]
+            if bet['session'] is not None and bet['amount'] is not None:
+                keys.append((Session, bet['session']))
+            for cls, guid in keys:
+                won_lost = counts[cls].setdefault(guid, [0, 0])
+                won_lost[0 if bet['won'] else 1] += 1
+        for cls, won_lost in counts.items():
+            self._add_bet_counts(cls, won_lost)
+        self._commit()
+        models = self.session.query(AILogregModel.guid, AILogregModel.won_bets, AILogregModel.lost_bets, AILogregModel.won_bets_pct)
+        for model in models.filter(AILogregModel.guid.in_(list(counts[AILogregModel]))):
+            self._update_best_models(model)
+        log.info('Bets recorded: %s' % len(bets))
+
+    # cls: AILogregModel or Session. counts: {guid: [won, lost]}
+    def _add_bet_counts(self, cls, counts):
+        if not counts:
+            return
+        table = cls.__table__
+        won_bets = table.c.won_bets + bindparam('won')
+        lost_bets = table.c.lost_bets + bindparam('lost')
+        values = {table.c.won_bets: won_bets, table.c.lost_bets: lost_bets}
+        if cls is AILogregModel:
+            values[table.c.won_bets_pct] = cast(won_bets, Float) / (won_bets + lost_bets) * 100.0  # never 0 bets here
+        update = table.update().where(table.c.guid == bindparam('b_guid')).values(values)
+        self.session.execute(update, [{'b_guid': guid, 'won': won, 'lost': lost} for guid, (won, lost) in counts.items()])
+
+    # won and lost bets of a model and/or a session, counted from the ledger. {'won', 'lost'}
+    def get_bet_stats(self, model_guid=None, session_guid=None):
+        q = self.session.query(func.sum(case([(Bet.won, 1)], else_=0)), func.sum(case([(Bet.won, 0)], else_=1)))
+        if model_guid is not None:
+            q = q.filter(Bet.model == model_guid)
+        if session_guid is not None:
+            q = q.filter(Bet.session == session_guid, Bet.amount != None)
+        return dict(zip(['won', 'lost'], [int(n or 0) for n in q.one()]))
+
+    # rates every fight again from scratch in one in-memory pass, then writes every fighter's rating in one bulk update.
+    # fight_features keeps the ratings fighters had before. to rebuild both, use backfill_fight_features(update_fighters=True)
+    # returns the number of fighters rated
+    def recompute_ratings(self, batch_size=10000):
+        log.info('Recomputing ratings with %s...' % type(self.ratings).__name__)
+        # straight from the DBAPI cursor, building a Row for every fight takes longer than rating it
+        fights = select([Fight.p1, Fight.p2, Fight.winner]).order_by(Fight.time, Fight.guid)
+        cursor = self.session.connection().connection.cursor()
+        cursor.execute(str(fights.compile(dialect=self.engine.dialect)))
+        ratings = self.ratings.recompute(row for rows in iter(lambda: cursor.fetchmany(batch_size), []) for row in rows)
+        cursor.close()
+        with self.unit_of_work():
+            self.session.query(Fighter).update({
+                Fighter.elo: self.ratings.start_rating,
+                Fighter.deviation: self.ratings.start_deviation
+            }, synchronize_session=False)
+            self.session.bulk_update_mappings(Fighter, [
+                {'guid': guid, 'elo': rating, 'deviation': deviation} for guid, (rating, deviation) in ratings.items()
+            ])
+        log.info('Ratings recomputed: %s fighters' % len(ratings))
+        return len(ratings)
 
     # returns newly created fighter
     def add_fighter(self, name):
-        new_fighter = Fighter(name=name)
+        new_fighter = Fighter(name=name, elo=self.ratings.start_rating, deviation=self.ratings.start_deviation)
         self.session.add(new_fighter)
-        self.session.commit()
+        self._commit()
         log.info('Fighter added %s' % new_fighter)
         return new_fighter
 
@@ -117,8 +478,65 @@ class SaltyDB:
         fights = self.session.query(Fight).filter(or_(Fight.p1 == guid, Fight.p2 == guid)).all()
         return fights
 
+    # head-to-head wins and total fight counts for both fighters in one aggregate query
+    # returns {'p1_wins', 'p2_wins', 'p1_fights', 'p2_fights'}
+    def get_matchup_stats(self, p1_guid, p2_guid):
+        stats = self._matchup_query(p1_guid, p2_guid).one()
+        return dict(zip(['p1_wins', 'p2_wins', 'p1_fights', 'p2_fights'], [int(n or 0) for n in stats]))
+
+    def _matchup_query(self, p1_guid, p2_guid):
+        p1_wins = or_(
+            and_(Fight.p1 == p1_guid, Fight.p2 == p2_guid, Fight.winner == 1),
+            and_(Fight.p1 == p2_guid, Fight.p2 == p1_guid, Fight.winner == 2)
+        )
+        p2_wins = or_(
+            and_(Fight.p1 == p2_guid, Fight.p2 == p1_guid, Fight.winner == 1),
+            and_(Fight.p1 == p1_guid, Fight.p2 == p2_guid, Fight.winner == 2)
+        )
+        p1_fights = or_(Fight.p1 == p1_guid, Fight.p2 == p1_guid)
+        p2_fights = or_(Fight.p1 == p2_guid, Fight.p2 == p2_guid)
+        return self.session.query(
+            func.sum(case([(p1_wins, 1)], else_=0)),
+            func.sum(case([(p2_wins, 1)], else_=0)),
+            func.sum(case([(p1_fights, 1)], else_=0)),
+            func.sum(case([(p2_fights, 1)], else_=0))
+        ).filter(or_(p1_fights, p2_fights))
+
+    # head-to-head win counts as (winner guid, loser guid, wins). only wins by fighter_guid if it is given
+    def get_head_to_head(self, fighter_guid=None):
+        winner_guid = case([(Fight.winner == 1, Fight.p1)], else_=Fight.p2)
+        loser_guid = case([(Fight.winner == 1, Fight.p2)], else_=Fight.p1)
+        q = self.session.query(winner_guid, loser_guid, func.count(1))
+        if fighter_guid is not None:
+            q = q.filter(or_(
+                and_(Fight.p1 == fighter_guid, Fight.winner == 1),
+                and_(Fight.p2 == fighter_guid, Fight.winner == 2)
+            ))
+        return q.group_by(winner_guid, loser_guid).all()
+
+    # the limit fighters who fought most recently
+    def get_recent_fighters(self, limit):
+        q = self.session.query(Fighter).join(Fight, or_(Fight.p1 == Fighter.guid, Fight.p2 == Fighter.guid))
+        q = q.group_by(Fighter.guid).order_by(desc(func.max(Fight.guid))).limit(limit)
+        return q.all()
+
+    # writes already-resolved fights in one commit.
+    # fights: dicts of Fight columns plus a 'features' dict of FightFeatures columns and optional 'bets', see add_bets
+    # fighters: dicts of guid and the new elo, wins and losses of every fighter in fights
+    def add_fights_bulk(self, fights, fighters):
+        with self.unit_of_work():
+            new_fights = [Fight(**{k: v for k, v in fight.items() if k not in ['features', 'bets']}) for fight in fights]
+            self.session.add_all(new_fights)
+            self.session.flush()
+            self.session.bulk_insert_mappings(FightFeatures, [
+                dict(fight['features'], fight=new_fight.guid) for fight, new_fight in zip(fights, new_fights)
+            ])
+            self.add_bets([dict(bet, fight=new_fight.guid) for fight, new_fight in zip(fights, new_fights) for bet in fight.get('bets', [])])
+            self.session.bulk_update_mappings(Fighter, fighters)
+        log.info('Fights recorded: %s' % len(new_fights))
+        return [new_fight.guid for new_fight in new_fights]
+
     # get p1's wins against p2. includes where #s reversed
-    # TODO: refactor to just return the number instead of full list (get_n_wins_against)
     def get_wins_against(self, p1_guid, p2_guid):
         wins = self.session.query(Fight).filter(or_(
             and_(Fight.p1 == p1_guid, Fight.p2 == p2_guid, Fight.winner == 1),
@@ -126,19 +544,19 @@ class SaltyDB:
         )).all()
         return wins
 
-    def increment_wins(self, fighter_guid, enemy_elo):
-        fighter = self.get_fighter_by_guid(fighter_guid)
-        fighter.wins += 1
-        fighter.elo = fighter.elo + (self.elo_stake * enemy_elo)
-        self.session.commit()
-        log.info('Incremented wins: %s' % fighter)
+    # the newest fight, or None
+    def get_last_fight_guid(self):
+        return self.session.query(func.max(Fight.guid)).scalar()
 
-    def increment_losses(self, fighter_guid):
-        fighter = self.get_fighter_by_guid(fighter_guid)
-        fighter.losses += 1
-        fighter.elo = fighter.elo - (self.elo_stake * fighter.elo)
-        self.session.commit()
-        log.info('Incremented losses: %s' % fighter)
+    # rates a fight and counts the win and the loss. winner, loser: Fighters
+    def _record_result(self, winner, loser):
+        (winner.elo, winner.deviation), (loser.elo, loser.deviation) = self.ratings.rate(
+            (winner.elo, winner.deviation), (loser.elo, loser.deviation)
+        )
+        winner.wins += 1
+        loser.losses += 1
+        self._commit()
+        log.info('Recorded win: %s, loss: %s' % (winner, loser))
 
     def start_session(self, balance):
         if balance is None:
@@ -149,10 +567,13 @@ class SaltyDB:
 
         new_session = Session(start_balance=balance)
         self.session.add(new_session)
-        self.session.commit()
+        self._commit()
         log.info('Session started: %s' % new_session)
         return new_session
 
+    def is_session_open(self, guid):
+        return self.session.query(Session.guid).filter(Session.guid == guid, Session.end_ts == None).first() is not None
+
     # does nothing if there are no open sessions, ends only the most recent session
     def end_session(self, balance):
         if balance is None:
@@ -164,7 +585,7 @@ class SaltyDB:
         for session in open_sessions:
             session.end_ts = last_fight
             session.end_balance = balance
-        self.session.commit()
+        self._commit()
         if len(open_sessions) == 0:
             log.info('No sessions to close')
         if len(open_sessions) > 1:
@@ -174,32 +595,105 @@ class SaltyDB:
         last_session = self.session.query(Session).filter(Session.guid == last_session_guid).first()
         return last_session
 
-    # TODO: this is causing oom errors in the kernel :(
-    # only need p1elo, p2elo, p1winsvp2, p2winsvp1, p1winpct, p2winpct, winner
     def get_training_data(self, test_mode=False, test_limit=100):
         log.info('Generating training data, this may take a while...')
-        f = aliased(Fight, name='f')
-        p1 = aliased(Fighter, name='p1')
-        p2 = aliased(Fighter, name='p2')
-        p1winsvp2 = self.session.query(func.count(1)).filter(or_(
-            and_(Fight.p1 == f.p1, Fight.p2 == f.p2, Fight.winner == 1),
-            and_(Fight.p1 == f.p2, Fight.p2 == f.p1, Fight.winner == 2)
-        )).label('p1winsvp2')
-        p2winsvp1 = self.session.query(func.count(1)).filter(or_(
-            and_(Fight.p1 == f.p1, Fight.p2 == f.p2, Fight.winner == 2),
-            and_(Fight.p1 == f.p2, Fight.p2 == f.p1, Fight.winner == 1)
-        )).label('p2winsvp1')
-
-        fights = self.session.query(f.winner, p1.elo, p2.elo, p1winsvp2, p2winsvp1, p1.winpct, p2.winpct)
-        fights = fights.join(p1, f.p1==p1.guid).join(p2, f.p2==p2.guid)
+        fights = self._training_query(test_mode, test_limit)
+        return [row._asdict() for row in fights.all()]
+
+    # same data as get_training_data, streamed through a server-side cursor.
+    # yields dicts of float64 column arrays keyed like get_training_data rows, at most batch_size long
+    # by_time: order by fight time instead of fight guid, eg. for a time based holdout. joins fights
+    # after, until: only fights with after < guid <= until, eg. those added since a cached high water mark
+    def iter_training_batches(self, batch_size=10000, test_mode=False, test_limit=100, by_time=False, after=None, until=None):
+        fights = self._training_query(test_mode, test_limit, by_time, after, until).yield_per(batch_size)
+        batch = []
+        for row in fights:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield _training_columns(batch)
+                batch = []
+        if batch:
+            yield _training_columns(batch)
+
+    # the newest fight with training features, or None
+    def get_training_high_water(self):
+        return self.session.query(func.max(FightFeatures.fight)).scalar()
+
+    # (# fights, newest fight or 0, elo_diff checksum) over the training features of fights up to until. cheap to
+    # aggregate in the DB, exact, and changes whenever those fights' features are rebuilt (eg. by a backfill with
+    # another rating engine). see training_checksum for the same checksum over training columns
+    def get_training_checksum(self, until):
+        ff = FightFeatures
+        micros = (ff.p1elo - ff.p2elo) * _CHECKSUM_SCALE
+        if self.engine.dialect.name != 'sqlite':
+            micros = func.trunc(micros)  # casts round elsewhere, sqlite's truncates like numpy's
+        count, last, checksum = self.session.query(
+            func.count(ff.fight), func.max(ff.fight), func.sum(cast(micros, BigInteger))
+        ).filter(ff.fight <= until).one()
+        return count, last or 0, int(checksum or 0)
+
+    # the SQL the training data is selected with, so caches of it can tell when the feature definitions change
+    def get_training_definition(self):
+        return str(self._training_query(False, 0).statement)
+
+    # sequential scan of fight_features, which holds stats as they were before each fight
+    def _training_query(self, test_mode, test_limit, by_time=False, after=None, until=None):
+        if self.session.query(FightFeatures.fight).first() is None and self.session.query(Fight.guid).first() is not None:
+            log.warning('fight_features is empty. Run "saltybetter backfill" to build it from existing fights.')
+        ff = FightFeatures
+        fights = self.session.query(
+            (ff.p1elo - ff.p2elo).label('elo_diff'),
+            (ff.p1winsvp2 - ff.p2winsvp1).label('wins_diff'),
+            (ff.p1winpct - ff.p2winpct).label('win_pct_diff'),
+            (ff.winner - 1).label('winner')  # -1 to put in range [0,1]
+        )
+        if by_time:
+            fights = fights.join(Fight, Fight.guid == ff.fight).order_by(Fight.time, ff.fight)
+        else:
+            fights = fights.order_by(ff.fight)
+        if after is not None:
+            fights = fights.filter(ff.fight > after)
+        if until is not None:
+            fights = fights.filter(ff.fight <= until)
         if test_mode:
             fights = fights.limit(test_limit)
-        return [{
-            'elo_diff': p1elo - p2elo,
-            'wins_diff': p1winsvp2 - p2winsvp1,
-            'win_pct_diff': p1winpct - p2winpct,
-            'winner': winner - 1  # -1 to put in range [0,1]
-        } for winner, p1elo, p2elo, p1winsvp2, p2winsvp1, p1winpct, p2winpct in fights.all()]
+        return fights
+
+
+# path of a file kept next to a SQLite database file, eg. a cache. None for other and in-memory databases
+def sidecar_path(conn_str, suffix):
+    url = make_url(conn_str)
+    if url.get_backend_name() != 'sqlite' or url.database in [None, '', ':memory:']:
+        return None
+    return url.database + suffix
+
+
+# get_training_checksum's elo_diff checksum of an elo_diff training column
+def training_checksum(elo_diff):
+    return int(np.trunc(elo_diff * _CHECKSUM_SCALE).astype(np.int64).sum())
+
+
+# drops the cached best models of a database, eg. when models were changed by another process
+def forget_best_models(conn_str):
+    with _best_models_lock:
+        for key in [key for key in _best_models if key[0] == conn_str]:
+            del _best_models[key]
+
+
+# whether a plan from explain_hot_queries reads a table or sorts without an index
+def scans_without_index(plan):
+    return any(('SCAN' in line and 'INDEX' not in line) or 'TEMP B-TREE' in line or 'Seq Scan' in line for line in plan)
+
+
+# in WAL mode readers don't block writers, so a long training read (eg. in the training worker) can't stall
+# the session's commits. the mode is stored in the file, setting it again is a no-op
+def _sqlite_wal(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA journal_mode=WAL')
+
+
+# rows of (elo_diff, wins_diff, win_pct_diff, winner) -> training columns
+def _training_columns(rows):
+    return dict(zip(TRAINING_FEATURES + ['winner'], np.array(rows, dtype=np.float64).T))
 
 
 class Fighter(Base):
@@ -207,7 +701,8 @@ class Fighter(Base):
 
     guid =      Column(Integer, primary_key=True)
     name =      Column(String, nullable=False, unique=True)
-    elo =       Column(Float, nullable=False, default=100)
+    elo =       Column(Float, nullable=False, default=100)  # the rating, whatever the RatingEngine
+    deviation = Column(Float)  # rating uncertainty, for engines that track it
     wins =      Column(Integer, nullable=False, default=0)
     losses =    Column(Integer, nullable=False, default=0)
 
@@ -242,6 +737,13 @@ class Fight(Base):
     time =      Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
     mode =      Column(String)
 
+    # (p1, ...) and (p2, ...) cover get_fights' OR on either side, and both orders of get_wins_against
+    __table_args__ = (
+        Index('ix_fights_p1_p2_winner', 'p1', 'p2', 'winner'),
+        Index('ix_fights_p2_p1_winner', 'p2', 'p1', 'winner'),
+        Index('ix_fights_time', 'time'),
+    )
+
     def __repr__(self):
         return '<Fight ({guid}): {time} - {p1} vs. {p2}>'.format(
             guid =      self.guid,
@@ -252,6 +754,23 @@ class Fight(Base):
         )
 
 
+# pre-fight stats for each fight, filled in by add_fight (or backfill_fight_features for old fights)
+class FightFeatures(Base):
+    __tablename__ = 'fight_features'
+
+    fight =     Column(Integer, ForeignKey('fights.guid'), primary_key=True)
+    p1elo =     Column(Float, nullable=False)
+    p2elo =     Column(Float, nullable=False)
+    p1winpct =  Column(Float, nullable=False)
+    p2winpct =  Column(Float, nullable=False)
+    p1winsvp2 = Column(Integer, nullable=False)
+    p2winsvp1 = Column(Integer, nullable=False)
+    winner =    Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return '<FightFeatures ({fight})>'.format(fight=self.fight)
+
+
 class Session(Base):
     __tablename__ = 'sessions'
 
@@ -271,18 +790,25 @@ class Session(Base):
         )
 
 
+# every model's pick for every fight, see SaltyDB.add_bets. only the bet model's pick is wagered
 class Bet(Base):
     __tablename__ = 'bets'
 
     guid =          Column(Integer, primary_key=True)
     fight =         Column(Integer, ForeignKey('fights.guid'), nullable=False)
-    session =       Column(Integer, ForeignKey('sessions.guid'), nullable=False)
-    # model =       Column(Integer, ForeignKey('ai_logreg_models.guid'), nullable=False)  # TODO: add model column
-    # on =            Column(Integer, ForeignKey('fighters.guid'), nullable=False)  # TODO: add on column
-    amount =        Column(Integer, nullable=False)
-    won =           Column(Boolean)
-    pre_balance =    Column(Integer, nullable=False)
-    profit =        Column(Integer)
+    session =       Column(Integer, ForeignKey('sessions.guid'))  # None outside a session
+    model =         Column(Integer, ForeignKey('ai_logreg_models.guid'), nullable=False)
+    on =            Column(Integer, ForeignKey('fighters.guid'), nullable=False)
+    amount =        Column(Integer)  # None if not wagered
+    won =           Column(Boolean, nullable=False)
+    pre_balance =    Column(Integer)
+    profit =        Column(Integer)  # None if not wagered, or the pots weren't known
+
+    # get_bet_stats counts by model or session
+    __table_args__ = (
+        Index('ix_bets_model_won', 'model', 'won'),
+        Index('ix_bets_session_won', 'session', 'won'),
+    )
 
     def __repr__(self):
         return '<Bet ({guid}): {wonlost} profit: {profit}>'.format(
@@ -299,6 +825,12 @@ class AILogregModel(Base):
     betas =     Column(String, nullable=False)
     won_bets =   Column(Integer, nullable=False, default=0)  # TODO: can we get rid of won/lost count once bets table is implemented?
     lost_bets =  Column(Integer, nullable=False, default=0)
+    won_bets_pct = Column(Float, nullable=False, default=0.0)  # kept in step with the counts, so rankings can use an index
+
+    # covers get_best_logreg_model's ranking, so it never reads the table itself
+    __table_args__ = (
+        Index('ix_ai_logreg_models_won_bets_pct', 'won_bets_pct', 'won_bets', 'lost_bets'),
+    )
 
     def __repr__(self):
         return '<AILogregModel ({guid}): {nfights} - {winpct}%>'.format(
@@ -307,21 +839,6 @@ class AILogregModel(Base):
             winpct =    None if self.won_bets + self.lost_bets == 0 else self.won_bets / (self.won_bets + self.lost_bets) * 100
         )
 
-    @hybrid_property
-    def won_bets_pct(self):
-        if self.won_bets + self.lost_bets == 0:
-            return 0.0
-        # noinspection PyTypeChecker
-        return float(self.won_bets) / (self.won_bets + self.lost_bets) * 100.0
-
-    # TODO: this doesn't work
-    @won_bets_pct.expression
-    def won_bets_pct(self):
-        return case(
-            [(self.won_bets + self.lost_bets == 0, 0.0)],
-            else_ =cast(self.won_bets, Float) / (self.won_bets + self.lost_bets) * 100.0
-        )
-
 
 class OpenSessionError(RuntimeError):
     def __init__(self, message, open_sessions):
@@ -331,6 +848,7 @@ class OpenSessionError(RuntimeError):
 
 
 if __name__ == '__main__':
-    db = SaltyDB('sqlite:///salt.db', True)
+    db = SaltyDB('sqlite:///salt.db', echo=True)
+    db.init_db()
     db.get_training_data(True)
     pass
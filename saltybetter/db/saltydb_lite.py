@@ -1,4 +1,8 @@
-from .saltydb import OpenSessionError, SaltyDB
+from .saltydb import OpenSessionError, SaltyDB, TRAINING_FEATURES
+from .replay import FightReplay
+from .ratings import StakeRating
+from contextlib import contextmanager
+import numpy as np
 import sqlite3
 import logging
 
@@ -42,12 +46,28 @@ class SaltyDBLite:
                 FOREIGN KEY(p2) REFERENCES fighters(guid)
             );
 
+            CREATE INDEX IF NOT EXISTS ix_fights_p1_p2_winner ON fights(p1, p2, winner);
+            CREATE INDEX IF NOT EXISTS ix_fights_p2_p1_winner ON fights(p2, p1, winner);
+            CREATE INDEX IF NOT EXISTS ix_fights_time ON fights(time);
+
             DROP VIEW IF EXISTS v_fights;
             CREATE VIEW IF NOT EXISTS v_fights AS
             SELECT *,
                 (SELECT MAX(guid) FROM sessions WHERE fights.time > sessions.startTS) AS session
             FROM fights;
 
+            CREATE TABLE IF NOT EXISTS fight_features(
+                fight INTEGER PRIMARY KEY,
+                p1elo REAL NOT NULL,
+                p2elo REAL NOT NULL,
+                p1winpct REAL NOT NULL,
+                p2winpct REAL NOT NULL,
+                p1winsvp2 INT NOT NULL,
+                p2winsvp1 INT NOT NULL,
+                winner INT NOT NULL,
+                FOREIGN KEY(fight) REFERENCES fights(guid)
+            );
+
             CREATE TABLE IF NOT EXISTS sessions(
                 guid INTEGER PRIMARY KEY,
                 startTS DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
@@ -100,15 +120,42 @@ class SaltyDBLite:
             FROM ai_logreg_models;
         ''')
         self.conn.commit()
+        self._uow_depth = 0
+
+    # groups every write made inside the block into one commit. rolls all of them back if the block raises.
+    # nests, only the outermost block commits.
+    @contextmanager
+    def unit_of_work(self):
+        self._uow_depth += 1
+        try:
+            yield self
+            if self._uow_depth == 1:
+                self.conn.commit()
+        except:
+            if self._uow_depth == 1:
+                self.conn.rollback()
+            raise
+        finally:
+            self._uow_depth -= 1
+
+    def _commit(self):
+        if not self._uow_depth:
+            self.conn.commit()
 
     def add_ai_logreg_model(self, serialized):
         result = self.conn.execute('INSERT INTO ai_logreg_models (betas) VALUES(?)', (serialized,))
-        self.conn.commit()
+        self._commit()
         result = self.conn.execute('SELECT * FROM ai_logreg_models WHERE ROWID=?', (result.lastrowid,))
         new_model = result.fetchone()
         log.info('Saved LogReg model: %s' % list(new_model))
         return new_model
 
+    # checkpoints models trained online. betas: {model guid: serialized betas}, all written in one commit
+    def update_logreg_models(self, betas):
+        self.conn.executemany('UPDATE ai_logreg_models SET betas=? WHERE guid=?', [(serialized, guid) for guid, serialized in betas.items()])
+        self._commit()
+        log.info('Checkpointed LogReg models: %s' % list(betas.keys()))
+
     def get_best_logreg_model(self, min_bets=0):
         result = self.conn.execute('SELECT * FROM v_ai_logreg_models WHERE wonBets + lostBets >= ? ORDER BY wonBetsPct DESC LIMIT 1', (min_bets,))
         return result.fetchone()
@@ -118,55 +165,89 @@ class SaltyDBLite:
             log.warning('Self fight detected. Ignoring. %s' % p1name)
             return
 
-        p1 = self.get_or_add_fighter(p1name)
-        p2 = self.get_or_add_fighter(p2name)
+        with self.unit_of_work():
+            p1 = self.get_or_add_fighter(p1name)
+            p2 = self.get_or_add_fighter(p2name)
+            # point-in-time features, captured before the elo and win/loss updates below
+            matchup = self.get_matchup_stats(p1['guid'], p2['guid'])
+            features = (
+                p1['elo'],
+                p2['elo'],
+                _winpct(p1),
+                _winpct(p2),
+                matchup['p1_wins'],
+                matchup['p2_wins'],
+                winner
+            )
 
-        if winner == 1:
-            self.increment_wins(p1['guid'], p2['elo'] if p2 else 0)
-            self.increment_losses(p2['guid'])
-        elif winner == 2:
-            self.increment_losses(p1['guid'])
-            self.increment_wins(p2['guid'], p1['elo'] if p1 else 0)
-        else:
-            raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
-
-        result = self.conn.execute('INSERT INTO fights (p1, p2, winner, mode) VALUES (?, ?, ?, ?)', (p1['guid'], p2['guid'], winner, mode))
-        self.conn.commit()
-        result = self.conn.execute('SELECT * FROM fights WHERE ROWID=?', (result.lastrowid,))
-        new_fight = list(result.fetchone())
-        log.info('Fight recorded %s' % new_fight)
-        return new_fight[0]
+            if winner == 1:
+                self.increment_wins(p1['guid'], p2['elo'] if p2 else 0)
+                self.increment_losses(p2['guid'])
+            elif winner == 2:
+                self.increment_losses(p1['guid'])
+                self.increment_wins(p2['guid'], p1['elo'] if p1 else 0)
+            else:
+                raise RuntimeError("Winner must be in [1, 2]: %s" % winner)
+
+            result = self.conn.execute('INSERT INTO fights (p1, p2, winner, mode) VALUES (?, ?, ?, ?)', (p1['guid'], p2['guid'], winner, mode))
+            self.conn.execute('''
+                INSERT INTO fight_features (fight, p1elo, p2elo, p1winpct, p2winpct, p1winsvp2, p2winsvp1, winner)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (result.lastrowid,) + features)
+            result = self.conn.execute('SELECT * FROM fights WHERE ROWID=?', (result.lastrowid,))
+            new_fight = list(result.fetchone())
+            log.info('Fight recorded %s' % new_fight)
+            return new_fight[0]
+
+    # rebuilds fight_features from scratch by replaying every fight in time order
+    def backfill_fight_features(self, batch_size=10000):
+        log.info('Backfilling fight features, this may take a while...')
+        self.conn.execute('DELETE FROM fight_features')
+        fights = self.conn.execute('SELECT guid, p1, p2, winner FROM fights ORDER BY time, guid')
+        n = 0
+        replay = FightReplay(StakeRating(self.elo_stake)).replay(fights)
+        while True:
+            batch = [features for _, features in zip(range(batch_size), replay)]
+            if not batch:
+                break
+            self.conn.executemany('''
+                INSERT INTO fight_features (fight, p1elo, p2elo, p1winpct, p2winpct, p1winsvp2, p2winsvp1, winner)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            n += len(batch)
+        self._commit()
+        log.info('Fight features backfilled: %s' % n)
+        return n
 
     def increment_session_wins(self, session_guid):
         result = self.conn.execute('UPDATE sessions SET wonBets = wonBets + 1 WHERE guid = ?', (session_guid,))
-        self.conn.commit()
+        self._commit()
 
     def increment_model_wins(self, model_guid):
         result = self.conn.execute('UPDATE ai_logreg_models SET wonBets = wonBets + 1 WHERE guid = ?', (model_guid,))
-        self.conn.commit()
+        self._commit()
 
     def increment_session_losses(self, session_guid):
         result = self.conn.execute('UPDATE sessions SET lostBets = lostBets + 1 WHERE guid = ?', (session_guid,))
-        self.conn.commit()
+        self._commit()
 
     def increment_model_losses(self, model_guid):
         result = self.conn.execute('UPDATE ai_logreg_models SET lostBets = lostBets + 1 WHERE guid = ?', (model_guid,))
-        self.conn.commit()
+        self._commit()
 
     # returns newly created fighter
     def add_fighter(self, name):
         result = self.conn.execute('INSERT INTO fighters (name) VALUES (?)', (name,))
-        self.conn.commit()
+        self._commit()
         new_fighter = self.get_fighter(result.lastrowid)
         log.info('Fighter added %s' % list(new_fighter))
         return new_fighter
 
-    # inherit
-    # def get_or_add_fighter(self, name):
-    #     fighter = self.get_fighter(name)
-    #     if not fighter:
-    #         fighter = self.add_fighter(name)
-    #     return fighter
+    def get_or_add_fighter(self, name):
+        fighter = self.get_fighter(name)
+        if not fighter:
+            fighter = self.add_fighter(name)
+        return fighter
 
     # fighter can be name or guid
     def get_fighter(self, fighter):
@@ -182,8 +263,21 @@ class SaltyDBLite:
         result = self.conn.execute('SELECT * FROM fights WHERE p1 = ? or p2 = ?', (guid, guid))
         return result.fetchall()
 
+    # head-to-head wins and total fight counts for both fighters in one aggregate query
+    # returns {'p1_wins', 'p2_wins', 'p1_fights', 'p2_fights'}
+    def get_matchup_stats(self, p1_guid, p2_guid):
+        result = self.conn.execute('''
+            SELECT
+            COALESCE(SUM((p1 = :p1 AND p2 = :p2 AND winner = 1) OR (p1 = :p2 AND p2 = :p1 AND winner = 2)), 0) AS p1_wins,
+            COALESCE(SUM((p1 = :p2 AND p2 = :p1 AND winner = 1) OR (p1 = :p1 AND p2 = :p2 AND winner = 2)), 0) AS p2_wins,
+            COALESCE(SUM(p1 = :p1 OR p2 = :p1), 0) AS p1_fights,
+            COALESCE(SUM(p1 = :p2 OR p2 = :p2), 0) AS p2_fights
+            FROM fights
+            WHERE p1 = :p1 OR p2 = :p1 OR p1 = :p2 OR p2 = :p2
+        ''', {'p1': p1_guid, 'p2': p2_guid})
+        return dict(result.fetchone())
+
     # get p1's wins against p2. includes where #s reversed
-    # TODO: refactor to just return the number instead of full list (get_n_wins_against)
     def get_wins_against(self, p1_guid, p2_guid):
         result = self.conn.execute('''
             SELECT * FROM fights 
@@ -200,7 +294,7 @@ class SaltyDBLite:
             'UPDATE fighters SET elo=elo+(?*?), wins=wins+1 WHERE guid=?',
             (self.elo_stake, enemy_elo, fighter_guid)
         )
-        self.conn.commit()
+        self._commit()
         updated = self.get_fighter(fighter_guid)
         log.info('Incremented wins: %s' % list(updated))
 
@@ -209,7 +303,7 @@ class SaltyDBLite:
             'UPDATE fighters SET elo=elo-(?*elo), losses=losses+1 WHERE guid=?',
             (self.elo_stake, fighter_guid)
         )
-        self.conn.commit()
+        self._commit()
         updated = self.get_fighter(fighter_guid)
         log.info('Incremented losses: %s' % list(updated))
 
@@ -222,7 +316,7 @@ class SaltyDBLite:
             raise OpenSessionError('A session is already open!', len(open_sessions))
 
         result = self.conn.execute('INSERT INTO sessions (startBalance) VALUES (?)', (balance,))
-        self.conn.commit()
+        self._commit()
 
         result = self.conn.execute('SELECT * FROM sessions WHERE guid=(SELECT MAX(guid) FROM sessions)')
         new_session = result.fetchone()
@@ -239,7 +333,7 @@ class SaltyDBLite:
         )
         if result.rowcount > 1:
             log.warning('More than one session closed: %s' % result.rowcount)
-        self.conn.commit()
+        self._commit()
 
         result = self.conn.execute('SELECT * FROM sessions WHERE guid=(SELECT MAX(guid) FROM sessions)')
         closed_session = result.fetchone()
@@ -247,34 +341,39 @@ class SaltyDBLite:
 
     def get_training_data(self, test_mode=False, test_limit=100):
         log.info('Generating training data, this may take a while...')
+        result = self._training_query(test_mode, test_limit)
+        data = result.fetchall()
+        log.info('Training data generated: %s' % len(data))
+        return data
+
+    # same data as get_training_data, read with fetchmany.
+    # yields dicts of float64 column arrays keyed like get_training_data rows, at most batch_size long
+    def iter_training_batches(self, batch_size=10000, test_mode=False, test_limit=100):
+        result = self._training_query(test_mode, test_limit)
+        keys = TRAINING_FEATURES + ['winner']
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            columns = np.array([tuple(row) for row in rows], dtype=np.float64).T
+            yield dict(zip(keys, columns))
+
+    # sequential scan of fight_features, which holds stats as they were before each fight
+    def _training_query(self, test_mode, test_limit):
         # winner - 1 to put in range 0,1. p() will predict probability of p2 winning
         result = self.conn.execute('''
             SELECT p1elo - p2elo AS elo_diff,
             p1winsvp2 - p2winsvp1 AS wins_diff,
             p1winpct - p2winpct AS win_pct_diff,
-            winner
-            FROM (
-                SELECT p1.elo AS p1elo, p2.elo AS p2elo,
-                (SELECT count(1) FROM fights 
-                    WHERE (p1 = f.p1 AND p2 = f.p2 AND winner = 1)
-                    OR    (p2 = f.p1 AND p1 = f.p2 AND winner = 2)
-                ) AS p1winsvp2,
-                (SELECT count(1) FROM fights 
-                    WHERE (p1 = f.p2 AND p2 = f.p1 AND winner = 1) 
-                    OR    (p2 = f.p2 AND p1 = f.p1 AND winner = 2)
-                ) AS p2winsvp1,
-                CAST(p1.wins AS FLOAT) / CAST((p1.wins + p1.losses) AS FLOAT) * 100 AS p1winpct,
-                CAST(p2.wins AS FLOAT) / CAST((p2.wins + p2.losses) AS FLOAT) * 100 AS p2winpct,
-                f.winner - 1 AS winner
-                FROM fights f
-                JOIN fighters p1 ON p1.guid = f.p1
-                JOIN fighters p2 ON p2.guid = f.p2
-                {test_limit}
-            )
+            winner - 1 AS winner
+            FROM fight_features
+            ORDER BY fight
+            {test_limit}
         '''.format(test_limit='LIMIT %s' % test_limit if test_mode else ''))
-        data = result.fetchall()
-        log.info('Training data generated: %s' % len(data))
-        return data
-
+        return result
 
 
+def _winpct(fighter):
+    if fighter['wins'] + fighter['losses'] == 0:
+        return 50.0
+    return float(fighter['wins']) / (fighter['wins'] + fighter['losses']) * 100
@@ -1,11 +1,16 @@
 from random import shuffle
 from decimal import Decimal
+import numpy as np
 import logging
 import json
 
 log = logging.getLogger(__name__)
 
 
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -500, 500)))
+
+
 # TODO: Make this an ABC
 class SaltyPredictor:
 
@@ -19,6 +24,8 @@ class SaltyPredictor:
 
 class LogRegression(SaltyPredictor):
     _ALPHA = 0.2
+    _ONLINE_ALPHA = 0.001  # a single unscaled fight moves the betas a lot more than a batch
+    _BATCH_SIZE = 64
 
     def __init__(self, betas):
         super().__init__()
@@ -34,18 +41,37 @@ class LogRegression(SaltyPredictor):
     # estimate probability of p2 winning
     def p(self, coefficients):
         super().p(coefficients)
-        coefficients['bias'] = Decimal(1)  # Should always be 1
-
         linear = Decimal(0)
         for k in self.betas:
-            linear += Decimal(self.betas[k]) * Decimal(coefficients[k])
+            x = Decimal(1) if k == 'bias' else Decimal(coefficients[k])  # bias always has coefficient 1
+            linear += Decimal(self.betas[k]) * x
 
         logified = Decimal(1) / (Decimal(1) + (linear * Decimal(-1)).exp())
         return logified
 
+    # online learning: one SGD step on a single fight result.
+    # coefficients: as for p. y: 1 if p2 won, else 0. returns the prediction from before the step
+    def learn(self, coefficients, y, alpha=None):
+        alpha = Decimal(self._ONLINE_ALPHA if alpha is None else alpha)
+        prediction = self.p(coefficients)
+        for beta in self.betas:
+            x = Decimal(1) if beta == 'bias' else Decimal(coefficients[beta])
+            self.betas[beta] = Decimal(self.betas[beta]) + alpha * (Decimal(y) - prediction) * x
+        return prediction
+
     # TODO: make this better... if new correct pct is worse, ignore?
-    def train(self, training_data, y_key, epochs=10):
+    # engine: 'numpy' for vectorized float64 gradient descent, 'decimal' for the original per-fight SGD
+    # batch_size: rows per gradient step for the numpy engine. None for full-batch
+    def train(self, training_data, y_key, epochs=10, engine='numpy', batch_size=_BATCH_SIZE):
         log.info('Betas: ' + str(self.betas))
+        if engine == 'numpy':
+            self._train_numpy(training_data, y_key, epochs, batch_size)
+        elif engine == 'decimal':
+            self._train_decimal(training_data, y_key, epochs)
+        else:
+            raise ValueError('Training engine must be in [numpy, decimal]: %s' % engine)
+
+    def _train_decimal(self, training_data, y_key, epochs):
         for i in range(epochs):
             correct = 0
             shuffle(training_data)
@@ -63,6 +89,93 @@ class LogRegression(SaltyPredictor):
             log.info('Betas: ' + str(self.betas))
             log.info('Correct pct: %s' % (correct / len(training_data) * 100))
 
+    def _train_numpy(self, training_data, y_key, epochs, batch_size):
+        keys = list(self.betas.keys())
+        x, y = self.pack(training_data, keys, y_key)
+        if len(y) == 0:
+            log.warning('No training data to train on')
+            return
+
+        w = self._beta_vector(keys)
+        for i in range(epochs):
+            correct = self._descend(w, x, y, batch_size)
+            self._set_betas(keys, w)
+            log.info('Betas: ' + str(self.betas))
+            log.info('Correct pct: %s' % (correct / len(y) * 100))
+
+    # batches: callable returning a fresh iterator of column batches ({key: array}) for every epoch,
+    #   e.g. lambda: db.iter_training_batches(10000). Only one batch is held in memory at a time.
+    def train_batches(self, batches, y_key, epochs=10, batch_size=_BATCH_SIZE):
+        log.info('Betas: ' + str(self.betas))
+        keys = list(self.betas.keys())
+        w = self._beta_vector(keys)
+        for i in range(epochs):
+            correct = 0
+            n = 0
+            for columns in batches():
+                x, y = self.pack_columns(columns, keys, y_key)
+                correct += self._descend(w, x, y, batch_size)
+                n += len(y)
+            if n == 0:
+                log.warning('No training data to train on')
+                return
+            self._set_betas(keys, w)
+            log.info('Betas: ' + str(self.betas))
+            log.info('Correct pct: %s' % (correct / n * 100))
+
+    # trains on an already packed feature matrix and label vector (see pack), columns ordered as keys
+    def fit(self, x, y, keys, epochs=10, batch_size=_BATCH_SIZE, alpha=_ALPHA):
+        w = self._beta_vector(keys)
+        for i in range(epochs):
+            correct = self._descend(w, x, y, batch_size, alpha)
+            log.debug('Correct pct: %s' % (correct / len(y) * 100))
+        self._set_betas(keys, w)
+
+    # one shuffled pass of mini-batch gradient descent over x, y. updates w in place, returns # correct predictions
+    def _descend(self, w, x, y, batch_size, alpha=_ALPHA):
+        n = len(y)
+        if batch_size is None or batch_size > n:
+            batch_size = n
+        correct = 0
+        order = np.random.permutation(n)
+        for start in range(0, n, batch_size):
+            batch = order[start:start + batch_size]
+            xb = x[batch]
+            prediction = _sigmoid(xb @ w)
+            correct += np.count_nonzero((prediction >= 0.5) == (y[batch] == 1))
+            w += alpha * (xb.T @ (y[batch] - prediction)) / len(batch)
+        return correct
+
+    def _beta_vector(self, keys):
+        return np.array([float(self.betas[k]) for k in keys], dtype=np.float64)
+
+    def _set_betas(self, keys, w):
+        # Decimal(float) is exact, so to_json/from_json round-trips these unchanged
+        self.betas = {k: Decimal(float(v)) for k, v in zip(keys, w)}
+
+    # packs rows of training data into a contiguous float64 feature matrix (columns ordered as keys) and label vector
+    # 'bias' in keys always gets a column of 1s
+    @staticmethod
+    def pack(training_data, keys, y_key):
+        n = len(training_data)
+        x = np.empty((n, len(keys)), dtype=np.float64)
+        for j, key in enumerate(keys):
+            if key == 'bias':
+                x[:, j] = 1.0
+            else:
+                x[:, j] = np.fromiter((row[key] for row in training_data), dtype=np.float64, count=n)
+        y = np.fromiter((row[y_key] for row in training_data), dtype=np.float64, count=n)
+        return x, y
+
+    # same as pack, but for a batch of columns ({key: array})
+    @staticmethod
+    def pack_columns(columns, keys, y_key):
+        y = np.asarray(columns[y_key], dtype=np.float64)
+        x = np.empty((len(y), len(keys)), dtype=np.float64)
+        for j, key in enumerate(keys):
+            x[:, j] = 1.0 if key == 'bias' else columns[key]
+        return x, y
+
     # b: beta val to update
     # y: actual classification
     # prediction: current probability of y=1
@@ -83,3 +196,78 @@ class LogRegression(SaltyPredictor):
         for k, v in json.loads(json_obj).items():
             betas[k] = Decimal(v)
         return cls(betas)
+
+
+# Scores a set of LogRegression models in one go. Their betas are stacked into a (models x features) float64
+# matrix, so a single matrix-vector product scores every model. Used like a dict of guid -> model, so the
+# models keep their own bet bookkeeping. Adding or removing a model only touches its row (and a new column
+# for a feature no model had before); the matrix grows by doubling.
+# Not thread safe, guard it with the same lock as the models.
+class ModelEnsemble:
+    _START_CAPACITY = 8
+
+    def __init__(self):
+        self.keys = []  # feature of each column
+        self._columns = {}  # feature -> column
+        self._models = {}  # guid -> model
+        self._rows = {}  # guid -> row
+        self._guids = []  # guid of each row
+        self._weights = np.zeros((self._START_CAPACITY, 0), dtype=np.float64)
+
+    def __setitem__(self, guid, model):
+        for key in model.betas:
+            if key not in self._columns:
+                self._columns[key] = len(self.keys)
+                self.keys.append(key)
+                self._weights = np.hstack([self._weights, np.zeros((len(self._weights), 1))])
+
+        if guid in self._rows:
+            row = self._rows[guid]
+        else:
+            row = len(self._guids)
+            if row == len(self._weights):
+                self._weights = np.vstack([self._weights, np.zeros_like(self._weights)])
+            self._rows[guid] = row
+            self._guids.append(guid)
+        self._weights[row] = 0.0
+        for key, beta in model.betas.items():
+            self._weights[row, self._columns[key]] = float(beta)
+        self._models[guid] = model
+
+    # moves the last row into the removed one
+    def __delitem__(self, guid):
+        row = self._rows.pop(guid)
+        last = len(self._guids) - 1
+        if row != last:
+            self._weights[row] = self._weights[last]
+            self._guids[row] = self._guids[last]
+            self._rows[self._guids[row]] = row
+        self._guids.pop()
+        del self._models[guid]
+
+    def __getitem__(self, guid):
+        return self._models[guid]
+
+    def __contains__(self, guid):
+        return guid in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    def __iter__(self):
+        return iter(self._models)
+
+    def items(self):
+        return self._models.items()
+
+    # returns (guids, (models x keys) betas). a view, copy it to keep it past the next change
+    def weights(self):
+        return list(self._guids), self._weights[:len(self._guids)]
+
+    # estimate probability of p2 winning for every model. returns {guid: probability}
+    def p(self, coefficients):
+        if type(coefficients) != dict:
+            raise TypeError('Prediction coefficients should be a dict')
+        x = np.array([1.0 if key == 'bias' else float(coefficients[key]) for key in self.keys], dtype=np.float64)
+        predictions = _sigmoid(self._weights[:len(self._guids)] @ x)
+        return dict(zip(self._guids, predictions.tolist()))
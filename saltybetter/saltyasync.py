@@ -0,0 +1,274 @@
+from . import saltysession
+from .db import saltydb
+from .db import fightercache
+from .saltyclient import AuthError, BalanceScanner, StateEvent
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import asyncio
+import logging
+import signal
+import time
+import json
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSaltyClient:
+    _PAGE_CHUNK_SIZE = 4096
+    _HEADERS = {
+        'Connection': 'keep-alive',
+    }  # no Host, it's derived from base_url
+
+    def __init__(self, base_url='http://www.saltybet.com'):
+        self.base_url = base_url.rstrip('/')
+        self.session = None
+        self.spoof_enabled = False
+        self._state_etag = None
+        self._state_last_modified = None
+
+    def spoof_login(self, spoof_cookie, user_agent):
+        headers = dict(self._HEADERS, Cookie=spoof_cookie)
+        headers['User-Agent'] = user_agent
+        log.info('User Agent: %s' % user_agent)
+        self.session = aiohttp.ClientSession(headers=headers)
+        self.spoof_enabled = True
+        log.info("Spoof'd cookie '%s'" % spoof_cookie)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def _get_text(self, path):
+        async with self.session.get(self.base_url + path) as response:
+            return await response.text()
+
+    async def _scan_balance(self):
+        async with self.session.get(self.base_url) as response:
+            scanner = BalanceScanner()
+            async for chunk in response.content.iter_chunked(self._PAGE_CHUNK_SIZE):
+                if scanner.feed(chunk):
+                    return scanner.value
+        raise AuthError('Not logged in! - No balance on the page')
+
+    # sources: which of 'ajax' and 'page' to fetch, concurrently. only those requests are made
+    async def get_wallet_balance(self, sources=('ajax', 'page')):
+        fetchers = {'ajax': lambda: self._get_text('/ajax_tournament_end.php'), 'page': self._scan_balance}
+        sources = [source for source in fetchers if source in sources]
+        balances = await asyncio.gather(*[fetchers[source]() for source in sources])
+
+        try:
+            return {source: None if not balance else int(balance) for source, balance in zip(sources, balances)}
+        except ValueError as e:
+            raise AuthError('Not logged in! - %s' % repr(e))
+
+    async def place_bet(self, player, amount):
+        amount = int(amount)
+        if player not in [1, 2]:
+            raise RuntimeError('Player to bet on must be in [1, 2]: %s' % player)
+        payload = {
+            'selectedplayer': 'player%s' % player,
+            'wager': amount
+        }
+        async with self.session.post(self.base_url + '/ajax_place_bet.php', data=payload) as response:
+            response.raise_for_status()  # so a bet that wasn't taken is never recorded as placed
+            await response.read()
+        log.info('Bet %s on player %s' % (amount, player))
+
+    async def get_tournament_balance(self):
+        return int(await self._get_text('/ajax_tournament_start.php'))
+
+    async def get_state(self):
+        return json.loads(await self._get_text('/state.json'))
+
+    # conditional get_state. returns None when state.json hasn't changed since the last call (304)
+    async def get_state_if_modified(self):
+        headers = {}
+        if self._state_etag is not None:
+            headers['If-None-Match'] = self._state_etag
+        if self._state_last_modified is not None:
+            headers['If-Modified-Since'] = self._state_last_modified
+        async with self.session.get(self.base_url + '/state.json', headers=headers) as response:
+            if response.status == 304:
+                return None
+            self._state_etag = response.headers.get('ETag')
+            self._state_last_modified = response.headers.get('Last-Modified')
+            return json.loads(await response.text())
+
+
+# StatePoller for the event loop. notify() starts a fetch unless one is running, in which case the running one
+# fetches once more when it's done. on_event is awaited for every transition before the next fetch, so events
+# are handled one at a time and in order.
+class AsyncStatePoller:
+
+    def __init__(self, client, on_event):
+        self.client = client
+        self.on_event = on_event
+        self.state = None
+        self._pending = False
+        self._task = None
+
+    def notify(self):
+        self._pending = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._pending:
+            self._pending = False
+            try:
+                event = await self.poll()
+            except (aiohttp.ClientError, ValueError) as e:
+                log.warning('Could not fetch state: %s' % repr(e))
+                continue
+            if event is not None:
+                await self.on_event(event)
+
+    async def poll(self):
+        state = await self.client.get_state_if_modified()
+        if state is None:
+            return None
+        event = StateEvent.transition(self.state, state)
+        self.state = state
+        return event
+
+
+# Minimal socket.io (engine.io v3) client over a websocket. Calls on_message for every 'message' event
+# and reconnects when the connection drops.
+class SocketListener:
+    _RECONNECT_DELAY = 5
+
+    def __init__(self, url, on_message):
+        self.url = url.rstrip('/') + '/socket.io/?EIO=3&transport=websocket'
+        self.on_message = on_message
+
+    async def listen(self, session):
+        while True:
+            try:
+                await self._listen_once(session)
+                log.warning('Socket closed. Reconnecting...')
+            except aiohttp.ClientError as e:
+                log.warning('Socket error: %s. Reconnecting in %ss...' % (e, self._RECONNECT_DELAY))
+                await asyncio.sleep(self._RECONNECT_DELAY)
+
+    async def _listen_once(self, session):
+        ping_task = None
+        try:
+            async with session.ws_connect(self.url) as ws:
+                log.info('Socket connected: %s' % self.url)
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    packet = msg.data
+                    if packet.startswith('0'):  # engine.io open, carries the ping interval
+                        interval = json.loads(packet[1:])['pingInterval'] / 1000
+                        ping_task = asyncio.ensure_future(self._ping(ws, interval))
+                    elif packet.startswith('42'):  # socket.io event
+                        event = json.loads(packet[2:])
+                        if event[0] == 'message':
+                            self.on_message(*event[1:])
+        finally:
+            if ping_task is not None:
+                ping_task.cancel()
+
+    @staticmethod
+    async def _ping(ws, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await ws.send_str('2')
+
+
+# SaltySession on an asyncio event loop. Wallet and tournament balances are fetched concurrently and
+# all DB work runs on a single worker thread so it never blocks the loop.
+class AsyncSaltySession(saltysession.SaltySession):
+
+    def __init__(self):
+        super().__init__()
+        self.client = AsyncSaltyClient(self.args.base_url)
+        self.poller = AsyncStatePoller(self.client, self._on_state_event)
+        self._db_executor = None
+
+    def start(self):
+        if self.args.init_db:
+            return super().start()
+        asyncio.run(self._run())
+
+    def _init_db_thread(self):
+        self.t_locals.db = saltydb.SaltyDB(self.args.database, echo=self.args.echo, ratings=self.ratings)
+        self.fighters = fightercache.FighterCache(self.t_locals.db, max_fighters=self.args.cache_size, flush_every=self.args.cache_flush)
+
+    def _run_db(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, stopping.set)
+
+        self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db', initializer=self._init_db_thread)
+        self.client.spoof_login(
+            '__cfduid=d953b3e8f82e16d65747e123665eb6d251613970875; PHPSESSID=o6fkdr4iem32k704v9jsdh3ks6;',
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36'
+        )
+        try:
+            await self._run_db(self.warm_start)
+            self.setup_models()
+            listener = SocketListener(self.args.socket_url, self._on_message)
+            listen_task = asyncio.ensure_future(listener.listen(self.client.session))
+            stop_task = asyncio.ensure_future(stopping.wait())
+            await asyncio.wait([listen_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+            log.warning('Exiting...')
+            # only the listener and in-flight messages are cancelled, this task stays alive to clean up
+            pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if listen_task.done() and not listen_task.cancelled() and listen_task.exception() is not None:
+                log.error('Socket listener failed: %s' % listen_task.exception())
+        finally:
+            try:
+                await self._run_db(self._shutdown)
+            finally:
+                await self.client.close()
+                self._db_executor.shutdown()
+                for signum in [signal.SIGINT, signal.SIGTERM]:
+                    loop.remove_signal_handler(signum)
+
+    def _on_message(self, *args):
+        log.debug('message received')
+        self.poller.notify()
+
+    async def _on_state_event(self, event):
+        try:
+            self.set_state(event.state)
+            log.info('State: %s' % self.state)
+
+            # fight over, have winner
+            if event.kind == StateEvent.WINNER:
+                log.info('Player %s wins!' % event.winner)
+                await self._run_db(self.record_fight)
+
+            elif event.kind == StateEvent.OPEN:
+                # the bet is decided on the DB thread while the balances are fetched
+                self._decided = None
+                plan, _ = await asyncio.gather(self._run_db(self.decide_bets), self.update_balances())
+                if plan.bet is not None:
+                    await self.client.place_bet(*plan.bet)
+                    log.info('Bet sent %.1fms after open' % ((time.perf_counter() - event.time) * 1000))
+                self._decided = plan  # only once the bet is in, see make_bets
+                await self._run_db(self.ensure_session)
+                log.info('Wallet: %s, Tournament Balance: %s' % (self.balance, self.tournament_balance))
+
+        except Exception as e:
+            log.exception('UH OH! %s' % e)
+
+    async def update_balances(self):
+        # gets tournament balance when in tournament mode, always gets tournament balance. both at once
+        if self.mode in ['normal', 'exhibition']:
+            wallet, tournament_balance = await asyncio.gather(
+                self.client.get_wallet_balance([self.args.balance_source]),
+                self.client.get_tournament_balance()
+            )
+            self.set_balances(wallet[self.args.balance_source], tournament_balance)
+        else:
+            self.set_balances(None, await self.client.get_tournament_balance())
@@ -0,0 +1,96 @@
+from . import saltyai
+import numpy as np
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# Replays the fight history against every combination of model and bet sizing at once.
+# Bets are sized like SaltySession.plan_bets: min_bet plus the model's confidence (|p - 0.5| / 0.5) times
+# (max_bet - min_bet), on every fight. A won bet pays amount * payout (saltybet's real odds aren't stored).
+# That makes each fight's profit a_t * min_bet + b_t * (max_bet - min_bet), with a_t = payout or -1 and
+# b_t = a_t * confidence, so the per-model sums are computed once and every sizing is a linear combination
+# of them. Unlike the session, wagers aren't rounded down to whole saltybux or capped by the balance.
+class Backtest:
+    _CHUNK_CELLS = 1 << 18  # fights x models x sizings evaluated at a time. small enough to stay in cache
+
+    # weights: (models x features) betas, as from ModelEnsemble.weights. sizing: [(min_bet, max_bet)]
+    def __init__(self, weights, sizing, start_balance=5000, payout=1.0):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.sizing = np.array([[min_bet for min_bet, _ in sizing], [max_bet - min_bet for min_bet, max_bet in sizing]], dtype=np.float64)
+        self.start_balance = start_balance
+        self.payout = payout
+
+    # x: (fights x features) in time order, columns as the weights'. y: 1 where p2 won, else 0.
+    # curve_every: also sample every combination's balance every that many fights.
+    # returns a dict of accuracy (models), and final balance, max drawdown and lowest balance (models x sizings),
+    # and curve ((samples x models x sizings), the balance after fights curve_every, 2 * curve_every, ...)
+    def run(self, x, y, curve_every=None):
+        n_models, n_sizing = len(self.weights), self.sizing.shape[1]
+        chunk_size = max(1, self._CHUNK_CELLS // (n_models * n_sizing))
+        correct = np.zeros(n_models)
+        totals = np.zeros((n_models, 2))  # running sums of a_t and b_t
+        peak = np.full((n_models, n_sizing), float(self.start_balance))
+        drawdown = np.zeros((n_models, n_sizing))
+        lowest = np.full((n_models, n_sizing), float(self.start_balance))
+        curve = []
+        # reused for every chunk, allocating them each time costs more than the arithmetic
+        balance = np.empty((chunk_size, n_models, n_sizing))
+        scratch = np.empty_like(balance)
+
+        for start in range(0, len(y), chunk_size):
+            p = saltyai._sigmoid(x[start:start + chunk_size] @ self.weights.T)  # (fights x models), p2 winning
+            won = (p > 0.5) == (y[start:start + chunk_size, None] == 1)
+            correct += won.sum(axis=0)
+            a = np.where(won, self.payout, -1.0)
+            sums = np.stack([a, a * np.abs(p - 0.5) / 0.5], axis=-1)  # (fights x models x 2)
+            np.cumsum(sums, axis=0, out=sums)
+            sums += totals
+            totals = sums[-1].copy()
+
+            n = len(p)
+            bal, peaks = balance[:n], scratch[:n]
+            np.matmul(sums, self.sizing, out=bal)  # both terms of every sizing in one go
+            bal += self.start_balance
+            np.minimum(lowest, bal.min(axis=0), out=lowest)
+
+            # a row at a time, np.maximum.accumulate is several times slower
+            np.maximum(peak, bal[0], out=peaks[0])
+            for i in range(1, n):
+                np.maximum(peaks[i - 1], bal[i], out=peaks[i])
+            peak = peaks[-1].copy()
+            peaks -= bal
+            np.maximum(drawdown, peaks.max(axis=0), out=drawdown)
+            if curve_every:
+                curve.append(bal[(curve_every - 1 - start) % curve_every::curve_every].copy())
+
+        final = self.start_balance + totals @ self.sizing
+        return {
+            'accuracy': correct / max(len(y), 1) * 100,
+            'final': final,
+            'drawdown': drawdown,
+            'lowest': lowest,
+            'curve': np.concatenate(curve) if curve else np.empty((0, n_models, n_sizing))
+        }
+
+
+# every (min_bet, max_bet) pair with min_bet <= max_bet
+def sizing_grid(min_bets, max_bets):
+    return [(min_bet, max_bet) for min_bet, max_bet in itertools.product(min_bets, max_bets) if min_bet <= max_bet]
+
+
+# the pre-fight features of every fight in time order, packed in keys order, and 1 where p2 won.
+# holdout: only the most recent fraction of fights
+def load_history(db, keys, holdout=1.0, batch_size=10000):
+    xs, ys = [], []
+    for columns in db.iter_training_batches(batch_size, by_time=True):
+        x, y = saltyai.LogRegression.pack_columns(columns, keys, 'winner')
+        xs.append(x)
+        ys.append(y)
+    if not ys:
+        return np.empty((0, len(keys))), np.empty(0)
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    skip = len(y) - int(round(len(y) * holdout))
+    log.info('Loaded %s fights, replaying the last %s' % (len(y), len(y) - skip))
+    return x[skip:], y[skip:]
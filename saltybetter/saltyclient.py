@@ -1,7 +1,9 @@
 import requests
 import logging
 import json
-from bs4 import BeautifulSoup
+import re
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
@@ -9,15 +11,17 @@ log = logging.getLogger(__name__)
 
 
 class SaltyClient:
-    _LOGIN_URL = 'http://saltybet.com/authenticate?signin=1'
-    _BET_URL = 'http://saltybet.com/ajax_place_bet.php'
+    _PAGE_CHUNK_SIZE = 4096
     _HEADERS = {
         'Connection': 'keep-alive',
-        'Host': 'www.saltybet.com',
-    }
+    }  # no Host, it's derived from base_url
 
-    def __init__(self):
+    # base_url: point at a local stand-in server (see saltyfake) instead of the live site
+    def __init__(self, base_url='http://www.saltybet.com'):
+        self.base_url = base_url.rstrip('/')
         self.spoof_enabled = False
+        self._state_etag = None
+        self._state_last_modified = None
 
     def spoof_login(self, spoof_cookie, user_agent):
         self._clean_session()
@@ -41,7 +45,7 @@ class SaltyClient:
             'authenticate': 'signin'
         }
         self._clean_session()
-        response = self.session.post(self._LOGIN_URL, data=payload)
+        response = self.session.post(self.base_url + '/authenticate?signin=1', data=payload)
         self.spoof_enabled = False
         log.info('Logged in as %s' % format(email))
 
@@ -52,20 +56,19 @@ class SaltyClient:
         self.session.headers.update(self._HEADERS)
 
     # TODO: Ajax doesn't work for some reason
-    def get_wallet_balance(self):
-        ajax_response = self.session.get('http://saltybet.com/ajax_tournament_end.php')
-        page_response = self.session.get('http://saltybet.com')
-        clean_html = page_response.text.strip().strip('<!DOCTYPE html">')
-
-        soup = BeautifulSoup(clean_html, 'html.parser')
-        page_balance = soup.find_all(id='b')[0]['value']
+    # sources: which of 'ajax' and 'page' to fetch. only those requests are made
+    def get_wallet_balance(self, sources=('ajax', 'page')):
+        balances = {}
+        if 'ajax' in sources:
+            ajax_response = self.session.get(self.base_url + '/ajax_tournament_end.php')
+            balances['ajax'] = ajax_response.text
+        if 'page' in sources:
+            # streamed, so the rest of the page is never downloaded once the balance is found
+            with self.session.get(self.base_url, stream=True) as page_response:
+                balances['page'] = scan_balance(page_response.iter_content(self._PAGE_CHUNK_SIZE))
 
-        # import pdb; pdb.set_trace()
         try:
-            return {
-                'ajax': None if not ajax_response.text else int(ajax_response.text),
-                'page': None if not page_balance else int(page_balance)
-            }
+            return {source: None if not balance else int(balance) for source, balance in balances.items()}
         except ValueError as e:
             raise AuthError('Not logged in! - %s' % repr(e))
 
@@ -77,18 +80,138 @@ class SaltyClient:
             'selectedplayer': 'player%s' % player,
             'wager': amount
         }
-        response = self.session.post(self._BET_URL, data=payload)
+        response = self.session.post(self.base_url + '/ajax_place_bet.php', data=payload)
+        response.raise_for_status()  # so a bet that wasn't taken is never recorded as placed
         log.info('Bet %s on player %s' % (amount, player))
 
     def get_tournament_balance(self):
-        response = self.session.get('http://saltybet.com/ajax_tournament_start.php')
+        response = self.session.get(self.base_url + '/ajax_tournament_start.php')
         return int(response.text)
 
     def get_state(self):
-        response = self.session.get('http://saltybet.com/state.json')
+        response = self.session.get(self.base_url + '/state.json')
         state = json.loads(response.text)
         return state
 
+    # conditional get_state. returns None when state.json hasn't changed since the last call (304)
+    def get_state_if_modified(self):
+        headers = {}
+        if self._state_etag is not None:
+            headers['If-None-Match'] = self._state_etag
+        if self._state_last_modified is not None:
+            headers['If-Modified-Since'] = self._state_last_modified
+        response = self.session.get(self.base_url + '/state.json', headers=headers)
+        if response.status_code == 304:
+            return None
+        self._state_etag = response.headers.get('ETag')
+        self._state_last_modified = response.headers.get('Last-Modified')
+        return json.loads(response.text)
+
+
+# A change of fight status in state.json. kind is OPEN, LOCKED or WINNER
+class StateEvent:
+    OPEN = 'open'
+    LOCKED = 'locked'
+    WINNER = 'winner'
+
+    def __init__(self, kind, state):
+        self.kind = kind
+        self.state = state
+        self.time = time.perf_counter()  # when the state was fetched
+
+    # returns the event for going from previous to state, or None if the fight status didn't change.
+    # changes to anything else, like the bet totals while locked, are not transitions
+    @classmethod
+    def transition(cls, previous, state):
+        key = (state['status'], state['p1name'], state['p2name'])
+        if previous is not None and key == (previous['status'], previous['p1name'], previous['p2name']):
+            return None
+        if state['status'] == 'open':
+            return cls(cls.OPEN, state)
+        elif state['status'] == 'locked':
+            return cls(cls.LOCKED, state)
+        elif state['status'] in ['1', '2']:
+            return cls(cls.WINNER, state)
+        log.warning('Unknown status: %s' % state['status'])
+        return None
+
+    @property
+    def winner(self):
+        return int(self.state['status']) if self.kind == self.WINNER else None
+
+    def __repr__(self):
+        return '<StateEvent {kind}: {p1} vs. {p2}>'.format(kind=self.kind, p1=self.state['p1name'], p2=self.state['p2name'])
+
+
+# Turns socket messages into StateEvents. notify() is called for every message, from any thread, and events()
+# fetches state.json once per burst: messages that arrive while a fetch is in flight add up to one more fetch.
+# Fetches are conditional, so unchanged states cost a 304 and no parsing.
+class StatePoller:
+
+    def __init__(self, client):
+        self.client = client
+        self.state = None
+        self._pending = threading.Event()
+
+    def notify(self):
+        self._pending.set()
+
+    # blocks, yielding an event for every transition
+    def events(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            try:
+                event = self.poll()
+            except (requests.RequestException, ValueError) as e:
+                log.warning('Could not fetch state: %s' % repr(e))
+                continue
+            if event is not None:
+                yield event
+
+    def poll(self):
+        state = self.client.get_state_if_modified()
+        if state is None:
+            return None
+        event = StateEvent.transition(self.state, state)
+        self.state = state
+        return event
+
+
+# Finds the balance in <input id="b" value="..."> from chunks of the homepage, without parsing the whole page.
+# Stops at the first chunk that completes the tag
+class BalanceScanner:
+    _TAG = re.compile(br'<input\b[^>]*\sid=["\']?b(?=["\'\s/>])[^>]*>', re.IGNORECASE)
+    _VALUE = re.compile(br'\svalue=["\']?([^"\'\s>]*)', re.IGNORECASE)
+
+    def __init__(self):
+        self._buffer = b''
+        self.found = False
+        self.value = None
+
+    # returns True once the tag is found. value is then set ('' when the tag has no value)
+    def feed(self, chunk):
+        self._buffer += chunk
+        tag = self._TAG.search(self._buffer)
+        if tag is not None:
+            value = self._VALUE.search(tag.group(0))
+            self.value = '' if value is None else value.group(1).decode('utf-8')
+            self.found = True
+            return True
+        # only an unfinished tag at the end can still match
+        start = self._buffer.rfind(b'<')
+        self._buffer = self._buffer[start:] if start != -1 else b''
+        return False
+
+
+def scan_balance(chunks):
+    scanner = BalanceScanner()
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            return scanner.value
+    raise AuthError('Not logged in! - No balance on the page')
+
+
 class AuthError(Exception):
     def __init__(self, message):
         super().__init__(message)
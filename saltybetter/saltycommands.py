@@ -0,0 +1,225 @@
+from .db import saltydb
+from .db import ratings
+import logging
+import argparse
+import datetime
+import itertools
+import time
+import json
+import csv
+import os
+import sys
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+# Maintenance subcommands, run as `saltybetter <command> [args]`.
+# Each takes the argv that follows the command name.
+
+def _db_arg_parser(prog):
+    arg_parser = argparse.ArgumentParser(prog='saltybetter %s' % prog)
+    arg_parser.add_argument('-db', '--database', default='sqlite:///salt.db', help='Database connection string to use')
+    arg_parser.add_argument('-e', '--echo', action='store_true', help='Echo DB queries to std.out')
+    return arg_parser
+
+
+# for commands that rate fights
+def _add_rating_arg(arg_parser):
+    arg_parser.add_argument('--rating', default='stake', choices=sorted(ratings.RATINGS), help='Rating algorithm for fighters')
+
+
+def backfill(argv):
+    arg_parser = _db_arg_parser('backfill')
+    arg_parser.description = 'Rebuild the point-in-time fight_features table by replaying all fights in time order'
+    arg_parser.add_argument('--batch_size', default=10000, type=int, help='Number of fights replayed per insert')
+    _add_rating_arg(arg_parser)
+    args = arg_parser.parse_args(argv)
+
+    db = saltydb.SaltyDB(args.database, echo=args.echo, ratings=ratings.RATINGS[args.rating]())
+    db.backfill_fight_features(batch_size=args.batch_size)
+
+
+def recompute_ratings(argv):
+    arg_parser = _db_arg_parser('ratings')
+    arg_parser.description = 'Recompute every fighter\'s rating from the full fight history with a rating algorithm'
+    arg_parser.add_argument('--batch_size', default=10000, type=int, help='Number of fights read from the DB at a time')
+    arg_parser.add_argument('--features', action='store_true',
+                            help='Also rebuild fight_features with the new ratings, so models can be trained on them. Slower')
+    _add_rating_arg(arg_parser)
+    args = arg_parser.parse_args(argv)
+
+    db = saltydb.SaltyDB(args.database, echo=args.echo, ratings=ratings.RATINGS[args.rating]())
+    if args.features:
+        db.backfill_fight_features(batch_size=args.batch_size, update_fighters=True)
+    else:
+        db.recompute_ratings(batch_size=args.batch_size)
+
+
+def indexes(argv):
+    arg_parser = _db_arg_parser('indexes')
+    arg_parser.description = 'Create any missing tables and indexes, then print the query plans of the hot queries. Exits with an error if any of them does not use an index'
+    arg_parser.add_argument('--no_create', action='store_true', help='Only print query plans, do not create missing indexes')
+    args = arg_parser.parse_args(argv)
+
+    db = saltydb.SaltyDB(args.database, echo=args.echo)
+    if not args.no_create:
+        db.init_db()
+    unindexed = []
+    for name, plan in db.explain_hot_queries().items():
+        print('%s:' % name)
+        for line in plan:
+            print('    %s' % line)
+        if saltydb.scans_without_index(plan):
+            unindexed.append(name)
+    if unindexed:
+        sys.exit('Queries not using an index: %s' % ', '.join(unindexed))
+
+
+# yields fights from a .csv (with a header row) or .jsonl fight log.
+# fields: p1name, p2name, winner (1, 2, or the winner's name), and optional mode and time (ISO 8601)
+def read_fight_log(path):
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            winner = row['winner']
+            if winner == row['p1name']:
+                winner = 1
+            elif winner == row['p2name']:
+                winner = 2
+            time = row.get('time')
+            yield {
+                'p1name': row['p1name'],
+                'p2name': row['p2name'],
+                'winner': int(winner),
+                'mode': row.get('mode') or None,
+                'time': datetime.datetime.strptime(time[:19].replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S') if time else None
+            }
+
+
+def import_log(argv):
+    arg_parser = _db_arg_parser('import')
+    arg_parser.description = 'Bulk import fight logs, then recompute fighter stats and fight features from the full history'
+    arg_parser.add_argument('files', nargs='+', help='.csv or .jsonl fight logs with p1name, p2name, winner and optional mode and time')
+    arg_parser.add_argument('--batch_size', default=10000, type=int, help='Number of rows per insert')
+    arg_parser.add_argument('--init_db', action='store_true', help='Create missing tables and indexes first, eg. to import into a new database')
+    _add_rating_arg(arg_parser)
+    args = arg_parser.parse_args(argv)
+
+    db = saltydb.SaltyDB(args.database, echo=args.echo, ratings=ratings.RATINGS[args.rating]())
+    if args.init_db:
+        db.init_db()
+    fights = [fight for path in args.files for fight in read_fight_log(path)]
+    db.import_fights(fights, batch_size=args.batch_size)
+
+
+def fake(argv):
+    from . import saltyfake  # needs aiohttp
+    arg_parser = argparse.ArgumentParser(prog='saltybetter fake')
+    arg_parser.description = 'Run a local stand-in for saltybet.com that replays fights. Point a session at it with --base_url and --socket_url'
+    arg_parser.add_argument('files', nargs='*', help='.csv or .jsonl fight logs to replay, as read by `saltybetter import`')
+    arg_parser.add_argument('--random', default=1000, type=int, help='Number of random fights to replay when no fight logs are given')
+    arg_parser.add_argument('--fighters', default=200, type=int, help='Number of fighters in the random fights')
+    arg_parser.add_argument('--seed', type=int, help='Seed for the random fights')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', default=8765, type=int)
+    arg_parser.add_argument('--speed', default=10.0, type=float, help='How many times faster than the site the fights are replayed')
+    arg_parser.add_argument('--burst', default=1, type=int, help='Socket messages pushed per state change')
+    arg_parser.add_argument('--lockstep', action='store_true', help='Advance as soon as the client has fetched each state and bet, instead of on a timer')
+    args = arg_parser.parse_args(argv)
+
+    if args.files:
+        fights = [fight for path in args.files for fight in read_fight_log(path)]
+    else:
+        fights = saltyfake.random_fights(args.random, args.fighters, seed=args.seed)
+    saltyfake.FakeSaltyServer(fights, speed=args.speed, lockstep=args.lockstep, burst=args.burst).run(args.host, args.port)
+
+
+def train(argv):
+    from . import saltytrain
+    arg_parser = _db_arg_parser('train')
+    arg_parser.description = 'Train a grid of LogReg models across processes, score them on the most recent fights and save the best'
+    arg_parser.add_argument('--rates', nargs='+', default=[0.01, 0.05, 0.2], type=float, help='Learning rates to try')
+    arg_parser.add_argument('--epochs', nargs='+', default=[5, 10, 20], type=int, help='Epoch counts to try')
+    arg_parser.add_argument('--features', nargs='+', default=saltydb.TRAINING_FEATURES, choices=saltydb.TRAINING_FEATURES,
+                            help='Features to try every non-empty subset of')
+    arg_parser.add_argument('--holdout', default=0.2, type=float, help='Fraction of the most recent fights kept out of training to score models on')
+    arg_parser.add_argument('--workers', type=int, help='Worker processes. Defaults to the number of CPUs')
+    arg_parser.add_argument('--keep', default=1, type=int, help='Number of the best models saved to the DB')
+    arg_parser.add_argument('--batch_size', default=10000, type=int, help='Number of fights read from the DB at a time')
+    args = arg_parser.parse_args(argv)
+
+    db = saltydb.SaltyDB(args.database, echo=args.echo)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'training.npy')
+        n_rows = saltytrain.write_training_file(db, path, batch_size=args.batch_size)
+        results = saltytrain.sweep(path, n_rows, saltytrain.grid(args.rates, args.epochs, args.features),
+                                   holdout=args.holdout, workers=args.workers)
+
+    print('%8s %6s %-40s %9s %9s' % ('rate', 'epochs', 'features', 'log loss', 'accuracy'))
+    for result in results:
+        print('%8s %6s %-40s %9.4f %8.2f%%' % (result['rate'], result['epochs'], ','.join(result['features']), result['log_loss'], result['accuracy']))
+    for result in results[:args.keep]:
+        db.add_ai_logreg_model(result['betas'])
+
+
+def backtest(argv):
+    from . import saltyai
+    from . import saltybacktest
+    arg_parser = _db_arg_parser('backtest')
+    arg_parser.description = 'Replay the fight history with saved LogReg models and bet sizings, and report how each combination would have done'
+    arg_parser.add_argument('--models', nargs='+', type=int, help='Guids of the models to replay. Defaults to every saved model')
+    arg_parser.add_argument('--min_bets', nargs='+', default=[10], type=int, help='min_bet values to try')
+    arg_parser.add_argument('--max_bets', nargs='+', default=[1000], type=int, help='max_bet values to try')
+    arg_parser.add_argument('--balance', default=5000, type=int, help='Starting balance')
+    arg_parser.add_argument('--payout', default=1.0, type=float, help='Winnings per saltybuck bet on a won bet. Pot odds are not recorded')
+    arg_parser.add_argument('--holdout', default=1.0, type=float,
+                            help='Fraction of the most recent fights to replay. Match `saltybetter train --holdout` to replay only fights its models were not trained on')
+    arg_parser.add_argument('--top', default=20, type=int, help='Number of the best combinations to print')
+    arg_parser.add_argument('--curve', help='Write the balance of every combination every --curve_every fights to this .csv')
+    arg_parser.add_argument('--curve_every', default=100, type=int)
+    arg_parser.add_argument('--batch_size', default=10000, type=int, help='Number of fights read from the DB at a time')
+    args = arg_parser.parse_args(argv)
+
+    db = saltydb.SaltyDB(args.database, echo=args.echo)
+    ensemble = saltyai.ModelEnsemble()
+    for model in db.get_logreg_models(args.models):
+        ensemble[model.guid] = saltyai.LogRegression.from_json(model.betas)
+    if not len(ensemble):
+        log.error('No models to replay')
+        return
+    guids, weights = ensemble.weights()
+    sizing = saltybacktest.sizing_grid(args.min_bets, args.max_bets)
+    x, y = saltybacktest.load_history(db, ensemble.keys, holdout=args.holdout, batch_size=args.batch_size)
+
+    start = time.perf_counter()
+    results = saltybacktest.Backtest(weights, sizing, args.balance, args.payout).run(x, y, args.curve_every if args.curve else None)
+    log.info('Replayed %s fights with %s combinations in %.2fs' % (len(y), len(guids) * len(sizing), time.perf_counter() - start))
+
+    combinations = sorted(itertools.product(range(len(guids)), range(len(sizing))), key=lambda ij: -results['final'][ij])
+    print('%6s %8s %8s %9s %10s %10s %10s' % ('model', 'min_bet', 'max_bet', 'accuracy', 'balance', 'drawdown', 'lowest'))
+    for i, j in combinations[:args.top]:
+        print('%6s %8s %8s %8.2f%% %10.0f %10.0f %10.0f' % (
+            guids[i], sizing[j][0], sizing[j][1], results['accuracy'][i], results['final'][i, j], results['drawdown'][i, j], results['lowest'][i, j]
+        ))
+
+    if args.curve:
+        with open(args.curve, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['fights'] + ['%s:%s-%s' % (guids[i], sizing[j][0], sizing[j][1]) for i, j in combinations])
+            for k, balances in enumerate(results['curve']):
+                writer.writerow([(k + 1) * args.curve_every] + ['%.0f' % balances[i, j] for i, j in combinations])
+
+
+COMMANDS = {
+    'backfill': backfill,
+    'backtest': backtest,
+    'fake': fake,
+    'import': import_log,
+    'indexes': indexes,
+    'ratings': recompute_ratings,
+    'train': train,
+}
@@ -0,0 +1,292 @@
+from aiohttp import web
+import asyncio
+import logging
+import random
+import json
+import math
+import time
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+log = logging.getLogger(__name__)
+
+
+# fighters get a hidden strength so the winners are learnable, like the real thing (mostly)
+def random_fights(n_fights, n_fighters, seed=None):
+    rng = random.Random(seed)
+    strengths = [rng.gauss(0, 1) for _ in range(n_fighters)]
+    for _ in range(n_fights):
+        p1, p2 = rng.sample(range(n_fighters), 2)
+        p1_wins = rng.random() < 1 / (1 + math.exp(strengths[p2] - strengths[p1]))
+        yield {
+            'p1name': 'fighter %s' % p1,
+            'p2name': 'fighter %s' % p2,
+            'winner': 1 if p1_wins else 2,
+            'mode': 'normal',
+            'time': None
+        }
+
+
+# engine.io v3 polling payloads, as socketIO-client reads and writes them: \x00, length digits, \xff, packet
+def _encode_payload(packets):
+    payload = bytearray()
+    for packet in packets:
+        data = packet.encode('utf-8')
+        payload.append(0)
+        payload.extend(int(digit) for digit in str(len(data)))
+        payload.append(255)
+        payload.extend(data)
+    return bytes(payload)
+
+
+def _decode_payload(payload):
+    packets = []
+    i = 0
+    while i < len(payload):
+        i += 1  # string/binary marker
+        length = 0
+        while payload[i] != 255:
+            length = length * 10 + payload[i]
+            i += 1
+        i += 1
+        packets.append(payload[i:i + length].decode('utf-8'))
+        i += length
+    return packets
+
+
+# Local stand-in for saltybet.com. Serves state.json, the wallet and tournament balances and bets, and pushes
+# socket.io 'message' events (engine.io v3 over polling or websocket) while replaying a sequence of fights.
+# Phases last as long as on the site divided by speed. In lockstep mode nothing is timed: each state is held
+# until a client has fetched it and betting stays open until a bet comes in, so the replay runs as fast as the
+# client can keep up.
+# GET /_stats reports message-to-bet latencies and fights replayed.
+class FakeSaltyServer:
+    _OPEN_SECONDS = 45
+    _FIGHT_SECONDS = 90
+    _PAYOUT_SECONDS = 15
+    _LOCKSTEP_TIMEOUT = 5  # lockstep: seconds to wait for a state fetch or a bet before moving on
+    _PING_INTERVAL = 25000
+    _PING_TIMEOUT = 60000
+    _REMAINING = {
+        'normal': '%s more matches until the next tournament!',
+        'tournament': '%s characters are left in the bracket!',
+        'exhibition': '%s exhibition matches left!'
+    }
+
+    # fights: iterable of dicts with p1name, p2name, winner and optional mode, as read by saltycommands.read_fight_log
+    # burst: socket messages pushed per state change. the site sends several
+    def __init__(self, fights, speed=1.0, lockstep=False, balance=5000, tournament_balance=1000, burst=1):
+        self.fights = fights
+        self.speed = speed
+        self.lockstep = lockstep
+        self.burst = burst
+        self.balance = balance
+        self.tournament_balance = tournament_balance
+        self.mode = 'normal'
+        self.state = {'p1name': '', 'p2name': '', 'p1total': '0', 'p2total': '0', 'status': 'locked', 'alert': '', 'x': 0,
+                      'remaining': self._REMAINING['normal'] % 100}
+        self.stats = {'fights': 0, 'bets': 0, 'latencies': [], 'elapsed': None, 'done': False, 'messages': 0, 'state_requests': 0, 'not_modified': 0}
+        self._state_version = 0
+        self._state_modified = time.time()
+        self._clients = {}  # sid -> [queue of engine.io packets, last seen]
+        self._bet = None  # (player, wager, seconds from the open message)
+        self._opened = None
+        self._connected = None
+        self._fetched = None
+        self._bet_placed = None
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.get('/', self._page),
+            web.get('/state.json', self._state),
+            web.get('/ajax_tournament_end.php', self._wallet_balance),
+            web.get('/ajax_tournament_start.php', self._tournament_balance),
+            web.post('/ajax_place_bet.php', self._place_bet),
+            web.get('/socket.io/', self._socket_get),
+            web.post('/socket.io/', self._socket_post),
+            web.get('/_stats', self._stats)
+        ])
+        app.on_startup.append(self._start_replay)
+        return app
+
+    async def _start_replay(self, app):
+        self._connected = asyncio.Event()
+        self._fetched = asyncio.Event()
+        self._bet_placed = asyncio.Event()
+        asyncio.ensure_future(self._replay())
+
+    async def _replay(self):
+        await self._connected.wait()
+        started = time.perf_counter()
+        log.info('Client connected. Replaying fights...')
+        for i, fight in enumerate(self.fights):
+            self.mode = fight.get('mode') or 'normal'
+            remaining = self._REMAINING[self.mode] % (100 - i % 99)
+            self._bet = None
+            self._bet_placed.clear()
+            await self._publish(fight, 'open', remaining, self._OPEN_SECONDS, self._bet_placed)
+            if self._bet is not None:
+                self.stats['bets'] += 1
+                self.stats['latencies'].append(self._bet[2])
+            await self._publish(fight, 'locked', remaining, self._FIGHT_SECONDS, self._fetched)
+            self._settle(fight['winner'])
+            await self._publish(fight, str(fight['winner']), remaining, self._PAYOUT_SECONDS, self._fetched)
+            self.stats['fights'] += 1
+            self.stats['elapsed'] = time.perf_counter() - started
+        self.stats['done'] = True
+        log.info('Replay done: %s fights in %.1fs' % (self.stats['fights'], self.stats['elapsed']))
+
+    # sets the state and pushes a message, then holds it for the phase or, in lockstep, until done is set
+    async def _publish(self, fight, status, remaining, seconds, done):
+        self.state = dict(self.state, p1name=fight['p1name'], p2name=fight['p2name'], status=status, remaining=remaining)
+        self._state_version += 1
+        self._state_modified = time.time()
+        self._fetched.clear()
+        self._opened = time.perf_counter()
+        for _ in range(self.burst):
+            self._broadcast('42["message"]')
+        self.stats['messages'] += self.burst
+        if not self.lockstep:
+            await asyncio.sleep(seconds / self.speed)
+            return
+        try:
+            await asyncio.wait_for(done.wait(), self._LOCKSTEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning('Timed out waiting on the client. Status: %s' % status)
+
+    # bets pay out 1:1
+    def _settle(self, winner):
+        if self._bet is None:
+            return
+        player, wager, _ = self._bet
+        won = wager if player == winner else -wager
+        if self.mode == 'tournament':
+            self.tournament_balance = max(self.tournament_balance + won, 0)
+        else:
+            self.balance = max(self.balance + won, 0)
+
+    async def _page(self, request):
+        return web.Response(content_type='text/html', text=(
+            '<!DOCTYPE html>\n<html><body>\n'
+            '<input type="hidden" name="b" id="b" value="%s">\n'
+            '</body></html>\n' % self.balance
+        ))
+
+    # honours If-None-Match, then If-Modified-Since (to the second, like the header)
+    async def _state(self, request):
+        self._fetched.set()
+        self.stats['state_requests'] += 1
+        etag = '"%s"' % self._state_version
+        headers = {'ETag': etag, 'Last-Modified': formatdate(self._state_modified, usegmt=True)}
+        if 'If-None-Match' in request.headers:
+            not_modified = request.headers['If-None-Match'] == etag
+        elif 'If-Modified-Since' in request.headers:
+            since = parsedate_to_datetime(request.headers['If-Modified-Since']).timestamp()
+            not_modified = int(self._state_modified) <= since
+        else:
+            not_modified = False
+        if not_modified:
+            self.stats['not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+        return web.json_response(self.state, headers=headers)
+
+    async def _wallet_balance(self, request):
+        return web.Response(text=str(self.balance))
+
+    async def _tournament_balance(self, request):
+        return web.Response(text=str(self.tournament_balance))
+
+    async def _place_bet(self, request):
+        data = await request.post()
+        if self.state['status'] != 'open' or self._bet is not None:
+            return web.Response(text='')
+        player = int(data['selectedplayer'][len('player'):])
+        self._bet = (player, int(data['wager']), time.perf_counter() - self._opened)
+        self._bet_placed.set()
+        return web.Response(text='1')
+
+    async def _stats(self, request):
+        return web.json_response(self.stats)
+
+    def _connect(self):
+        sid = uuid.uuid4().hex
+        queue = asyncio.Queue()
+        queue.put_nowait('40')  # socket.io connect to the default namespace
+        self._clients[sid] = [queue, time.monotonic()]
+        self._connected.set()
+        log.info('Socket client connected: %s' % sid)
+        return sid, queue
+
+    def _open_packet(self, sid):
+        return '0' + json.dumps({'sid': sid, 'upgrades': [], 'pingInterval': self._PING_INTERVAL, 'pingTimeout': self._PING_TIMEOUT})
+
+    def _broadcast(self, packet):
+        now = time.monotonic()
+        for sid, (queue, last_seen) in list(self._clients.items()):
+            if now - last_seen > self._PING_TIMEOUT / 1000:
+                log.info('Socket client timed out: %s' % sid)
+                del self._clients[sid]
+            else:
+                queue.put_nowait(packet)
+
+    async def _socket_get(self, request):
+        if request.query.get('transport') == 'websocket':
+            return await self._websocket(request)
+
+        sid = request.query.get('sid')
+        if sid is None:
+            sid, _ = self._connect()
+            return self._polling_response([self._open_packet(sid)])
+        if sid not in self._clients:
+            return web.json_response({'code': 1, 'message': 'Session ID unknown'}, status=400)
+
+        queue = self._clients[sid][0]
+        self._clients[sid][1] = time.monotonic()
+        try:
+            packets = [await asyncio.wait_for(queue.get(), self._PING_INTERVAL / 1000)]
+        except asyncio.TimeoutError:
+            packets = ['6']  # noop
+        while not queue.empty():
+            packets.append(queue.get_nowait())
+        return self._polling_response(packets)
+
+    async def _socket_post(self, request):
+        sid = request.query.get('sid')
+        if sid not in self._clients:
+            return web.json_response({'code': 1, 'message': 'Session ID unknown'}, status=400)
+        self._clients[sid][1] = time.monotonic()
+        for packet in _decode_payload(await request.read()):
+            if packet.startswith('2'):  # ping
+                self._clients[sid][0].put_nowait('3' + packet[1:])
+        return web.Response(text='ok')
+
+    @staticmethod
+    def _polling_response(packets):
+        return web.Response(body=_encode_payload(packets), content_type='application/octet-stream')
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sid, queue = self._connect()
+        await ws.send_str(self._open_packet(sid))
+
+        async def send_queued():
+            while True:
+                await ws.send_str(await queue.get())
+
+        sender = asyncio.ensure_future(send_queued())
+        try:
+            async for msg in ws:
+                self._clients[sid][1] = time.monotonic()
+                if msg.type == web.WSMsgType.TEXT and msg.data.startswith('2'):
+                    queue.put_nowait('3' + msg.data[1:])
+        finally:
+            sender.cancel()
+            self._clients.pop(sid, None)
+            log.info('Socket client disconnected: %s' % sid)
+        return ws
+
+    def run(self, host='127.0.0.1', port=8765):
+        log.info('Fake saltybet listening on http://%s:%s' % (host, port))
+        web.run_app(self.app(), host=host, port=port, print=None)
@@ -1,12 +1,21 @@
 from . import saltyclient
 from .db import saltydb
+from .db import fightercache
+from .db import ratings
 from . import saltyai
+from . import saltytrain
+from . import saltysnapshot
 from socketIO_client import SocketIO, LoggingNamespace
 import logging
 import signal
 import sys
 import argparse
 import threading
+import multiprocessing
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 
 # logging.basicConfig(filename='salty.log', format='%(asctime)s-%(name)s-%(levelname)s: %(message)s', level=logging.INFO)
@@ -16,7 +25,6 @@ log = logging.getLogger(__name__)
 
 # TODO: Try Tensorflow/Keras
 # TODO: add % based min/max bets
-# TODO: implement --init_db as below
 
 class SaltySession:
 
@@ -28,79 +36,198 @@ class SaltySession:
         arg_parser.add_argument('-p', '--password', help='Saltybet login password. Currently non-functional. You must spoof login!')
         arg_parser.add_argument('-t', '--test', type=int, default=0, help='Test mode. Puts a limiter on the training data query so it doesn\'t take forever')
         arg_parser.add_argument('-e', '--echo', action='store_true', help='Echo DB queries to std.out')
-        arg_parser.add_argument('--init_db', action='store_true', help='Test connection to the DB and initialize tables')
+        arg_parser.add_argument('--init_db', action='store_true', help='Test connection to the DB, create missing tables, columns and indexes, then exit. Run once for a new database')
         arg_parser.add_argument('--max_bet', default=1000, type=int, help='The maximum amount of saltybux saltybetter will bet')
         arg_parser.add_argument('--min_bet', default=10, type=int, help='The minimum amount of saltybux saltybetter will bet')
         arg_parser.add_argument('--balance_source', default='page', choices=['page', 'ajax'],
                                 help='Where saltybetter will look for the current wallet balance. Valid values are "page" and "ajax". Currently, only "page" works.')
+        arg_parser.add_argument('--train_engine', default='numpy', choices=['numpy', 'decimal'],
+                                help='Engine used to train new models. "numpy" is fast, "decimal" is the slow per-fight SGD kept for reproducibility.')
+        arg_parser.add_argument('--train_batch_size', default=10000, type=int,
+                                help='Number of fights read from the DB at a time when training with the numpy engine')
+        arg_parser.add_argument('--training_cache',
+                                help='File to cache the training data in, so startup training only queries new fights. Defaults to next to SQLite database files, "" to turn off')
+        arg_parser.add_argument('--asyncio', action='store_true',
+                                help='Run the session on an asyncio event loop, fetching balances concurrently and writing to the DB off the loop. Requires aiohttp.')
+        arg_parser.add_argument('--online', action='store_true',
+                                help='Update every active model with one SGD step per finished fight, using the features the bet was decided on')
+        arg_parser.add_argument('--online_rate', type=float, help='Learning rate of the online updates. Defaults to a small rate suited to single fights')
+        arg_parser.add_argument('--online_checkpoint', default=20, type=int, help='Number of online updates between saving model betas to the DB')
+        arg_parser.add_argument('--base_url', default='http://www.saltybet.com', help='Saltybet site to use. Point at `saltybetter fake` to run against a local stand-in')
+        arg_parser.add_argument('--socket_url', default='https://www.saltybet.com:2096', help='Saltybet socket.io server to listen to for state changes')
+        arg_parser.add_argument('--rating', default='stake', choices=sorted(ratings.RATINGS),
+                                help='Rating algorithm for fighters. Use the one the ratings in the DB were computed with, see `saltybetter ratings`')
+        arg_parser.add_argument('--snapshot',
+                                help='File the session snapshots its models and fighter cache to, to start betting right away after a restart. Defaults to next to SQLite database files, "" to turn off')
+        arg_parser.add_argument('--snapshot_every', default=25, type=int, help='Number of fights between snapshots while running. One is also taken on exit')
+        arg_parser.add_argument('--cache_size', default=10000, type=int, help='Maximum number of fighters kept in the in-memory fighter cache')
+        arg_parser.add_argument('--cache_flush', default=1, type=int,
+                                help='Number of fights cached before they are written to the DB. Above 1, fights are no longer committed together with their bet stats.')
         self.args = arg_parser.parse_args()
 
         # TODO: make some of these "private"
         self.t_locals = threading.local()
-        self.t_locals.client = saltyclient.SaltyClient()
-        self.t_locals.db = saltydb.SaltyDB(self.args.database, echo=self.args.echo)
-        # self.socket = SocketIO('www-cdn-twitch.saltybet.com', 1337, LoggingNamespace)
-        self.socket = SocketIO('https://www.saltybet.com', 2096, LoggingNamespace)
-        self.socket.on('message', self._on_message)
+        self.t_locals.client = saltyclient.SaltyClient(self.args.base_url)
+        self.poller = saltyclient.StatePoller(self.t_locals.client)
+        self.ratings = ratings.RATINGS[self.args.rating]()
+        self.t_locals.db = saltydb.SaltyDB(self.args.database, echo=self.args.echo, ratings=self.ratings)
+        self.fighters = fightercache.FighterCache(self.t_locals.db, max_fighters=self.args.cache_size, flush_every=self.args.cache_flush)
+        self.socket = None
         self.state = None
         self.mode = None
         self.balance = None
         self.tournament_balance = None
         self.session_id = None
-        self.models = {}
+        self.models = saltyai.ModelEnsemble()
         self.bet_model_id = None
+        self._bet_plan = None
+        self._decided = None  # the plan whose bet was placed, recorded in the bets ledger when the fight ends
+        self._online_updates = 0  # since the last checkpoint
+        self._balance_executor = None
         self._threads = []
+        self._trainer = None
+        self._snapshot_path = saltydb.sidecar_path(self.args.database, '.snapshot') if self.args.snapshot is None else self.args.snapshot
+        self._snapshot_fights = 0  # since the last snapshot
+        self._reconciled = None  # fighter cache rebuilt from the DB after restoring a stale snapshot, until swapped in
+        self._fought = None  # names of fighters that fought since the stale snapshot was restored
 
         self._locks = {
             'models': threading.Lock()
         }
 
     def start(self):
+        if self.args.init_db:
+            self.t_locals.db.init_db()
+            log.info('DB initialized: %s' % self.args.database)
+            return
+
         # self.t_locals.client.login(self.args.username, self.args.password)
         self.t_locals.client.spoof_login(
             '__cfduid=d953b3e8f82e16d65747e123665eb6d251613970875; PHPSESSID=o6fkdr4iem32k704v9jsdh3ks6;',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36'
         )
 
+        # fetches the wallet and tournament balances alongside the bet decision and each other, with this thread's client
+        self._balance_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='balances')
+
         signal.signal(signal.SIGINT, self.stop)
         signal.signal(signal.SIGTERM, self.stop)
+        self.warm_start()
         self.setup_models()
-        self.socket.wait()
+        # self.socket = SocketIO('www-cdn-twitch.saltybet.com', 1337, LoggingNamespace)
+        socket_url = urlsplit(self.args.socket_url)
+        socket_port = socket_url.port or (443 if socket_url.scheme == 'https' else 80)
+        self.socket = SocketIO('%s://%s' % (socket_url.scheme, socket_url.hostname), socket_port, LoggingNamespace)
+        self.socket.on('message', self._on_message)
+        # the socket only wakes the poller, state fetches and betting happen here on the main thread
+        threading.Thread(name='socket', target=self.socket.wait, daemon=True).start()
+        for event in self.poller.events():
+            self._on_state_event(event)
 
     # TODO: check if threads are running and close gracefully?.
     def stop(self, signum=None, frame=None):
-        self.t_locals.db.end_session(self.balance)
+        self._shutdown()
         log.warning('Exiting... %s: %s' % (signum, frame))
         sys.exit()
 
-    def setup_models(self):
-        # train new logreg model and add to active models to use for this session
-        def new_model():
-            self.t_locals.db = saltydb.SaltyDB(self.args.database, echo=self.args.echo)
-            training_data = self.t_locals.db.get_training_data(test_mode=self.args.test, test_limit=self.args.test)
-            if not training_data:
-                log.warning('%s thread done. No new model created because no training data was found.' % threading.current_thread().name)
-                return
-
-            ai_schema = [key for key in training_data[0].keys() if key != 'winner']
-            trained_model = saltyai.LogRegression(ai_schema)
-            trained_model.train(training_data, 'winner')
-            trained_model_id = self.t_locals.db.add_ai_logreg_model(trained_model.to_json()).guid
+    def _shutdown(self):
+        self.fighters.flush()
+        if self._online_updates:
+            self.checkpoint_models()
+        if self.balance is not None:
+            self.t_locals.db.end_session(self.balance)
+            self.session_id = None
+        self.save_snapshot()
+        self.t_locals.db.close()
+
+    # restores the active models, fighter cache and open session from the last snapshot, so betting can start
+    # before the DB has been asked anything but the newest fight. without one, warms the fighter cache from the DB.
+    # the models are reconciled by setup_models as usual; if fights were recorded after the snapshot was taken
+    # (eg. after a crash) the fighter cache is rebuilt in the background and swapped in between fights
+    def warm_start(self):
+        state = saltysnapshot.load(self._snapshot_path, self.args.database, self.args.rating) if self._snapshot_path else None
+        if state is None:
+            self.fighters.warm()
+            return
+
+        self.fighters.load(state['fighters'])
+        self._locks['models'].acquire()
+        for guid, betas in state['models'].items():
+            self.models[guid] = saltyai.LogRegression.from_json(betas)
+        self.bet_model_id = state['bet_model_id']
+        self._locks['models'].release()
+        if state['session_id'] is not None and self.t_locals.db.is_session_open(state['session_id']):
+            self.session_id = state['session_id']
+
+        if self.t_locals.db.get_last_fight_guid() != state['high_water']:
+            log.info('Snapshot is behind the DB. Reloading fighters in the background.')
+            self._fought = set()
+            threading.Thread(name='reconcile', target=self._reconcile_fighters, daemon=True).start()
+
+    def _reconcile_fighters(self):
+        self.t_locals.db = saltydb.SaltyDB(self.args.database, echo=self.args.echo, ratings=self.ratings)
+        fighters = fightercache.FighterCache(self.t_locals.db, max_fighters=self.args.cache_size, flush_every=self.args.cache_flush)
+        fighters.warm()
+        self._reconciled = fighters
+        self.t_locals.db.close()
+        log.info('%s thread done.' % threading.current_thread().name)
+
+    # swaps in the fighter cache rebuilt by _reconcile_fighters, once it's done. fighters that fought since the
+    # restore may have been read before their fights were written, so they are left to be reloaded when needed.
+    # runs on the thread that owns the fighter cache
+    def _swap_reconciled(self):
+        fighters = self._reconciled
+        if fighters is None:
+            return
+        self.fighters.flush()
+        for name in self._fought:
+            fighters.discard(name)
+        fighters.db = self.t_locals.db
+        self.fighters = fighters
+        self._reconciled = None
+        self._fought = None
+        log.info('Swapped in the fighter cache reloaded from the DB')
+
+    # flushes the fighter cache, so the snapshot matches the DB up to its newest fight.
+    # skipped while a stale snapshot's fighters are still being reloaded, the old snapshot is still known stale
+    def save_snapshot(self):
+        self._snapshot_fights = 0
+        self._swap_reconciled()
+        if not self._snapshot_path or self._fought is not None:
+            return
+        self.fighters.flush()
+        self._locks['models'].acquire()
+        models = {guid: model.to_json() for guid, model in self.models.items()}
+        bet_model_id = self.bet_model_id
+        self._locks['models'].release()
+        saltysnapshot.save(self._snapshot_path, {
+            'database': self.args.database,
+            'rating': self.args.rating,
+            'high_water': self.t_locals.db.get_last_fight_guid(),
+            'models': models,
+            'bet_model_id': bet_model_id,
+            'session_id': self.session_id,
+            'fighters': self.fighters.dump()
+        })
 
-            self._locks['models'].acquire()
-            if self.bet_model_id is None:
-                self.bet_model_id = trained_model_id
-            self.models[trained_model_id] = trained_model
-            self._locks['models'].release()
-            log.info('%s thread done. Created new model %s' % (threading.current_thread().name, trained_model_id))
+    def setup_models(self):
+        # train new logreg model in a worker process, so training never holds the GIL the betting loop needs.
+        # it's added to the active models for this session when it arrives
+        ctx = multiprocessing.get_context('spawn')
+        receiver, sender = ctx.Pipe(duplex=False)
+        self._trainer = ctx.Process(name='train_model', target=saltytrain.train_worker, daemon=True, args=(
+            sender, self.args.database, self.args.train_engine, self.args.train_batch_size, self.args.test, self.args.echo,
+            saltytrain.default_cache_path(self.args.database) if self.args.training_cache is None else self.args.training_cache
+        ))
+        self._trainer.start()
+        sender.close()  # so recv sees EOF when the worker is done
 
         # get best logreg model and add to active models
         def best_model():
             self.t_locals.db = saltydb.SaltyDB(self.args.database, echo=self.args.echo)
             bet_model_row = self.t_locals.db.get_best_logreg_model(min_bets=400)
             if bet_model_row is None:
-                bet_model_row = self.t_locals.db.get_best_logreg_model(min_bets=0)
-            if bet_model_row is None: # still!
+                self.t_locals.db.close()
                 log.warning('%s thread done. Could not find a best model.' % threading.current_thread().name)
                 return
 
@@ -110,53 +237,124 @@ class SaltySession:
                 self.models[self.bet_model_id] = saltyai.LogRegression.from_json(bet_model_row.betas)
             self._locks['models'].release()
             log.info('%s thread done. Using best model: %s' % (threading.current_thread().name, bet_model_row))
+            self.t_locals.db.close()
 
-        self._threads.append(threading.Thread(name='train_model', target=new_model))
+        self._threads.append(threading.Thread(name='train_model', target=self._receive_models, args=(receiver,), daemon=True))
         self._threads.append(threading.Thread(name='best_model', target=best_model))
         for thread in self._threads:
             thread.start()
             log.info('%s thread started.' % thread.name)
 
+    # hot-swaps models sent by the training worker into the active models
+    def _receive_models(self, receiver):
+        while True:
+            try:
+                trained_model_id, betas = receiver.recv()
+            except EOFError:
+                log.info('Training worker done.')
+                return
+
+            saltydb.forget_best_models(self.args.database)  # saved by the worker, in a process of its own
+            trained_model = saltyai.LogRegression.from_json(betas)
+            self._locks['models'].acquire()
+            if self.bet_model_id is None:
+                self.bet_model_id = trained_model_id
+            self.models[trained_model_id] = trained_model
+            self._locks['models'].release()
+            log.info('Added newly trained model %s' % trained_model_id)
+
     def _on_message(self, *args):
+        log.debug('message received')
+        self.poller.notify()
+
+    def _on_state_event(self, event):
         try:
-            log.info('message received')
-            old_state = self.state
-            self.update_state()
-            if old_state != self.state:
-                log.info('State: %s' % self.state)
-
-                # fight over, have winner
-                if self.state['status'] in ['1', '2']:
-                    log.info('Player %s wins!' % self.state['status'])
-                    self.t_locals.db.add_fight(self.state['p1name'], self.state['p2name'], int(self.state['status']), self.mode)
-                    self.update_bet_stats()
-                    # TODO: retrain with new fight results?
-
-                elif self.state['status'] == 'open':
-                    self.update_balances()
-                    if self.session_id is None and self.mode in ['normal', 'exhibition']:
-                        try:
-                            self.session_id = self.t_locals.db.start_session(self.balance).guid
-                        except saltydb.OpenSessionError:
-                            self.t_locals.db.end_session(self.balance)
-                            self.session_id = self.t_locals.db.start_session(self.balance).guid
-
-                    log.info('Wallet: %s, Tournament Balance: %s' % (self.balance, self.tournament_balance))
-                    self.make_bets()
+            self.set_state(event.state)
+            log.info('State: %s' % self.state)
+
+            # fight over, have winner
+            if event.kind == saltyclient.StateEvent.WINNER:
+                log.info('Player %s wins!' % event.winner)
+                self.record_fight()
+
+            elif event.kind == saltyclient.StateEvent.OPEN:
+                self.make_bets(event.time)
+                self.ensure_session()
+                log.info('Wallet: %s, Tournament Balance: %s' % (self.balance, self.tournament_balance))
 
         except Exception as e:
             log.exception('UH OH! %s' % e)
 
+    def record_fight(self):
+        self._swap_reconciled()
+        if self._fought is not None:
+            self._fought.update([self.state['p1name'], self.state['p2name']])
+        # fight, elo updates and the bets ledger all land in one commit
+        with self.t_locals.db.unit_of_work():
+            self.fighters.add_fight(self.state['p1name'], self.state['p2name'], int(self.state['status']), self.mode, self.collect_bets())
+        if self.args.online:
+            self.learn_fight()
+        self._snapshot_fights += 1
+        if self._snapshot_fights >= self.args.snapshot_every:
+            self.save_snapshot()
+
+    # one SGD step for every active model on the fight that just finished, from the features its bet was planned with
+    def learn_fight(self):
+        plan = self._bet_plan
+        if plan is None or (plan.p1name, plan.p2name) != (self.state['p1name'], self.state['p2name']):
+            log.info('No bet plan for %s vs. %s. Not learning from it.' % (self.state['p1name'], self.state['p2name']))
+            return
+
+        y = int(self.state['status']) - 1  # models predict p2 winning
+        self._locks['models'].acquire()
+        for guid, model in list(self.models.items()):
+            model.learn(plan.features, y, self.args.online_rate)
+            self.models[guid] = model  # refreshes its betas in the ensemble
+        self._locks['models'].release()
+
+        self._online_updates += 1
+        if self._online_updates >= self.args.online_checkpoint:
+            self.checkpoint_models()
+
+    def checkpoint_models(self):
+        self._locks['models'].acquire()
+        betas = {guid: model.to_json() for guid, model in self.models.items()}
+        self._locks['models'].release()
+        self.t_locals.db.update_logreg_models(betas)
+        self._online_updates = 0
+
+    def ensure_session(self):
+        if self.session_id is None and self.mode in ['normal', 'exhibition']:
+            try:
+                self.session_id = self.t_locals.db.start_session(self.balance).guid
+            except saltydb.OpenSessionError:
+                self.t_locals.db.end_session(self.balance)
+                self.session_id = self.t_locals.db.start_session(self.balance).guid
+
     def update_balances(self):
-        # gets tournament balance when in tournament mode
-        old_balance = None
+        self._set_fetched_balances(*self._fetch_balances())
+
+    # starts fetching the wallet balance (when in a mode that uses it) and the tournament balance, side by side on
+    # the balance executor. returns their futures, the wallet's None if it isn't fetched. neither waits on the other,
+    # so the pool can't starve whatever its size
+    def _fetch_balances(self):
+        wallet = None
         if self.mode in ['normal', 'exhibition']:
+            wallet = self._balance_executor.submit(self.t_locals.client.get_wallet_balance, [self.args.balance_source])
+        return wallet, self._balance_executor.submit(self.t_locals.client.get_tournament_balance)
+
+    def _set_fetched_balances(self, wallet, tournament_balance):
+        self.set_balances(None if wallet is None else wallet.result()[self.args.balance_source], tournament_balance.result())
+
+    # balance: None when not in a mode that uses the wallet
+    def set_balances(self, balance, tournament_balance):
+        old_balance = None
+        if balance is not None:
             old_balance = self.balance
-            self.balance = self.t_locals.client.get_wallet_balance()[self.args.balance_source]
+            self.balance = balance
 
-        # will always get tournament balance
         old_tournament_balance = self.tournament_balance
-        self.tournament_balance = self.t_locals.client.get_tournament_balance()
+        self.tournament_balance = tournament_balance
 
         if old_balance is not None and self.balance < old_balance:
             log.info('Lost bet! Old balance: %s, New balance: %s, Profit: %s' % (
@@ -176,20 +374,53 @@ class SaltySession:
                 old_tournament_balance, self.tournament_balance, self.tournament_balance - old_tournament_balance
             ))
 
-    def update_bet_stats(self):
+    # rows for the bets ledger: every model's pick for the fight that just ended, from the plan whose bet was placed.
+    # models added after that have no pick. the bet model's row carries the wager
+    def collect_bets(self):
+        plan = self._decided
+        self._decided = None
+        if plan is None or (plan.p1name, plan.p2name) != (self.state['p1name'], self.state['p2name']):
+            log.info('No bets decided on %s vs. %s. None recorded.' % (self.state['p1name'], self.state['p2name']))
+            return []
+
         winner = int(self.state['status'])  # 1 or 2
-        for guid, model in self.models.items():
-            if winner == model.bet:
-                self.t_locals.db.increment_model_wins(guid)
-                if self.session_id and guid == self.bet_model_id:
-                    self.t_locals.db.increment_session_wins(self.session_id)
-            else:
-                self.t_locals.db.increment_model_losses(guid)
-                if self.session_id and guid == self.bet_model_id:
-                    self.t_locals.db.increment_session_losses(self.session_id)
+        on = {
+            1: self.fighters.get_or_add_fighter(plan.p1name).guid,
+            2: self.fighters.get_or_add_fighter(plan.p2name).guid
+        }
+        bets = []
+        for guid, player in plan.picks.items():
+            bet = {
+                'session': self.session_id if self.mode in ['normal', 'exhibition'] else None,  # tournament bets have no session
+                'model': guid,
+                'on': on[player],
+                'won': player == winner,
+                'amount': None,
+                'pre_balance': None,
+                'profit': None
+            }
+            if guid == plan.bet_model_id and plan.bet is not None:
+                bet['amount'] = int(plan.bet[1])
+                bet['pre_balance'] = self.tournament_balance if self.mode == 'tournament' else self.balance
+                bet['profit'] = self.get_profit(bet['amount'], bet['won'])
+            bets.append(bet)
+        return bets
+
+    # winners split the losing pot in proportion to their share of the winning pot. None if the pots aren't known
+    def get_profit(self, amount, won):
+        if not won:
+            return -amount
+        totals = {player: int(str(self.state.get('p%stotal' % player, 0)).replace(',', '')) for player in [1, 2]}
+        winner = int(self.state['status'])
+        if totals[winner] == 0:
+            return None
+        return int(math.ceil(amount * totals[3 - winner] / totals[winner]))
 
     def update_state(self):
-        self.state = self.t_locals.client.get_state()
+        return self.set_state(self.t_locals.client.get_state())
+
+    def set_state(self, state):
+        self.state = state
         if 'more matches until the next tournament!' in self.state['remaining'] or 'Tournament mode will be activated after the next match!' in self.state['remaining']:
             self.mode = 'normal'
         elif 'characters are left in the bracket!' in self.state['remaining'] or 'FINAL ROUND!' in self.state['remaining']:
@@ -200,13 +431,31 @@ class SaltySession:
             raise RuntimeError('Could not determine mode: %s' % self.state['remaining'])
         return self.state
 
-    def make_bets(self):
-        p1 = self.t_locals.db.get_or_add_fighter(self.state['p1name'])
-        p2 = self.t_locals.db.get_or_add_fighter(self.state['p2name'])
-        p1_wins = len(self.t_locals.db.get_wins_against(p1.guid, p2.guid))
-        p2_wins = len(self.t_locals.db.get_wins_against(p2.guid, p1.guid))
-        p1_fights = len(self.t_locals.db.get_fights(p1.guid))
-        p2_fights = len(self.t_locals.db.get_fights(p2.guid))
+    # balances are fetched while the bet is decided, then the wager goes out straight away.
+    # opened: perf_counter time the open state was seen, for timing
+    def make_bets(self, opened=None):
+        self._decided = None
+        balances = self._fetch_balances()
+        plan = self.decide_bets()
+        decided = time.perf_counter()
+        self._set_fetched_balances(*balances)
+        if plan.bet is not None:
+            self.t_locals.client.place_bet(*plan.bet)
+            if opened is not None:
+                log.info('Bet sent %.1fms after open (decided after %.1fms)' % ((time.perf_counter() - opened) * 1000, (decided - opened) * 1000))
+        # only once the bet is in. if fetching the balances or placing the bet fails, nothing is recorded for the fight
+        self._decided = plan
+
+    # scores every active model for a matchup without recording anything
+    def plan_bets(self, p1name, p2name):
+        self._swap_reconciled()
+        p1 = self.fighters.get_or_add_fighter(p1name)
+        p2 = self.fighters.get_or_add_fighter(p2name)
+        matchup = self.fighters.get_matchup_stats(p1, p2)
+        p1_wins = matchup['p1_wins']
+        p2_wins = matchup['p2_wins']
+        p1_fights = matchup['p1_fights']
+        p2_fights = matchup['p2_fights']
         # TODO: think of a better solution to avoid / by 0?
         p1_winpct = 50.0 if p1.wins + p1.losses == 0 else p1.wins / (p1.wins + p1.losses) * 100
         p2_winpct = 50.0 if p2.wins + p2.losses == 0 else p2.wins / (p2.wins + p2.losses) * 100
@@ -231,18 +480,19 @@ class SaltySession:
             nFights=p2_fights
         ))
 
+        picks = {}
+        bet = None
+        bet_model_id = None
         self._locks['models'].acquire()
-        for guid, model in self.models.items():
-            prediction = model.p(p_coeffs)
-
+        for guid, prediction in self.models.p(p_coeffs).items():
             if prediction > 0.5:
-                model.bet = 2
+                picks[guid] = 2
             elif prediction <= 0.5:
-                model.bet = 1
+                picks[guid] = 1
 
             if guid == self.bet_model_id:
-                bet_amount = ((abs(float(prediction) - 0.5) / 0.5) * (self.args.max_bet - self.args.min_bet)) + self.args.min_bet
-                log.info('Bet Prediction(%s): Player %s (%s)' % (guid, model.bet, prediction))
+                bet_amount = ((abs(prediction - 0.5) / 0.5) * (self.args.max_bet - self.args.min_bet)) + self.args.min_bet
+                log.info('Bet Prediction(%s): Player %s (%s)' % (guid, picks[guid], prediction))
 
                 # sanity checks
                 if bet_amount < self.args.min_bet:
@@ -252,11 +502,39 @@ class SaltySession:
                     log.warning('bet_amount (%s) greater than max_bet! Forced max_bet (%s).' % (bet_amount, self.args.max_bet))
                     bet_amount = self.args.max_bet
 
-                self.t_locals.client.place_bet(model.bet, bet_amount)
+                bet = (picks[guid], bet_amount)
+                bet_model_id = guid
             else:
-                log.info('Prediction(%s): Player %s (%s)' % (guid, model.bet, prediction))
+                log.info('Prediction(%s): Player %s (%s)' % (guid, picks[guid], prediction))
         self._locks['models'].release()
+        self._bet_plan = BetPlan(p1name, p2name, p_coeffs, picks, bet, bet_model_id)
+        return self._bet_plan
+
+    # records every model's pick for the current matchup. returns the plan, with the (player, amount) to bet
+    # for the bet model, or None, as its bet
+    def decide_bets(self):
+        plan = self.plan_bets(self.state['p1name'], self.state['p2name'])
+
+        self._locks['models'].acquire()
+        for guid, pick in plan.picks.items():
+            self.models[guid].bet = pick
+        self._locks['models'].release()
+        return plan
+
+
+# Every model's pick for a matchup, and the bet to place
+class BetPlan:
+
+    def __init__(self, p1name, p2name, features, picks, bet, bet_model_id):
+        self.p1name = p1name
+        self.p2name = p2name
+        self.features = features  # model coefficients the picks were made from
+        self.picks = picks  # model guid -> player
+        self.bet = bet  # (player, amount) or None
+        self.bet_model_id = bet_model_id  # the model bet is from
 
+    def __repr__(self):
+        return '<BetPlan {p1} vs. {p2}: {bet}>'.format(p1=self.p1name, p2=self.p2name, bet=self.bet)
 
 if __name__ == '__main__':
     SaltySession().start()
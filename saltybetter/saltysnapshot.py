@@ -0,0 +1,44 @@
+import datetime
+import logging
+import pickle
+import os
+
+log = logging.getLogger(__name__)
+
+_VERSION = 1  # bump when the contents change
+
+
+# A session's warm state, so a restarted session can bet without waiting on the DB: a dict of
+#   database, rating: what it was taken with. it's only used with the same ones
+#   high_water: guid of the newest fight in the DB when it was taken, fighter stats include every fight up to it
+#   models: {guid: serialized betas} of the active models, bet_model_id, session_id: the open session or None
+#   fighters: the fighter cache, see FighterCache.dump
+# Pickled, it's written and read in milliseconds even with a full fighter cache. It is only ever read back from
+# the file the session wrote itself.
+def save(path, state):
+    state = dict(state, version=_VERSION, time=datetime.datetime.utcnow())
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)  # so a crash never leaves a half written snapshot
+    log.info('Snapshot saved: %s fighters, %s models, up to fight %s' % (len(state['fighters']), len(state['models']), state['high_water']))
+
+
+# the snapshot at path if there is a usable one, else None
+def load(path, database, rating):
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        log.warning('Could not read snapshot %s: %s' % (path, e))
+        return None
+
+    if state.get('version') != _VERSION:
+        log.info('Ignoring snapshot %s: old version %s' % (path, state.get('version')))
+        return None
+    if (state['database'], state['rating']) != (database, rating):
+        log.info('Ignoring snapshot %s: taken with database %s, rating %s' % (path, state['database'], state['rating']))
+        return None
+    log.info('Snapshot loaded: taken %s, up to fight %s' % (state['time'], state['high_water']))
+    return state
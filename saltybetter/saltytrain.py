@@ -0,0 +1,195 @@
+from .db import saltydb
+from . import saltyai
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import itertools
+import logging
+import hashlib
+import json
+import os
+
+log = logging.getLogger(__name__)
+
+
+# column layout of the training file
+COLUMNS = ['bias'] + saltydb.TRAINING_FEATURES + ['winner']
+
+
+# Streams the training data, oldest fight first, into a .npy file that workers memory-map instead of
+# having it pickled to them. returns the number of rows
+def write_training_file(db, path, batch_size=10000):
+    n = db.session.query(saltydb.FightFeatures).count()
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(n, len(COLUMNS)))
+    row = 0
+    for columns in db.iter_training_batches(batch_size, by_time=True):
+        rows = len(columns['winner'])
+        for j, key in enumerate(COLUMNS):
+            data[row:row + rows, j] = 1.0 if key == 'bias' else columns[key]
+        row += rows
+    data.flush()
+    del data
+    return row
+
+
+# On-disk cache of the training data in COLUMNS layout, one fight per row in fight guid order: raw float64s
+# (no header, so it can be appended to) plus a .json of what it covers, up to the high water fight guid.
+# update() appends only the fights added since and memory-maps the lot. It starts over when the file layout or
+# the feature definitions change, or the cached fights' features no longer match the DB (eg. after a backfill).
+class TrainingCache:
+    _VERSION = 2  # bump when the file layout or the .json changes
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path + '.json'
+
+    # brings the cache up to date with db. returns the cached rows, memory-mapped read only
+    def update(self, db, batch_size=10000):
+        high_water = db.get_training_high_water() or 0
+        meta = self._load_meta()
+        fresh = self._fresh_meta(db)
+        if meta is not None and not self._valid(db, meta, fresh):
+            meta = None
+        if meta is None:
+            log.info('Building training cache %s' % self.path)
+            meta = fresh
+        elif meta['high_water'] < high_water:
+            log.info('Updating training cache %s from fight %s' % (self.path, meta['high_water']))
+
+        if meta['high_water'] < high_water or not os.path.exists(self.path):
+            with open(self.path, 'ab') as f:
+                f.truncate(meta['rows'] * len(COLUMNS) * 8)  # drop rows from an append that didn't finish
+                for columns in db.iter_training_batches(batch_size, after=meta['high_water'], until=high_water):
+                    rows = np.empty((len(columns['winner']), len(COLUMNS)))
+                    for j, key in enumerate(COLUMNS):
+                        rows[:, j] = 1.0 if key == 'bias' else columns[key]
+                    f.write(rows.tobytes())
+                    meta['rows'] += len(rows)
+                    meta['checksum'] += saltydb.training_checksum(columns['elo_diff'])
+            meta['high_water'] = max(meta['high_water'], high_water)
+            self._save_meta(meta)
+        log.info('Training cache %s: %s fights up to fight %s' % (self.path, meta['rows'], meta['high_water']))
+        return self.load(meta)
+
+    # the cached rows, memory-mapped read only
+    def load(self, meta=None):
+        meta = meta or self._load_meta()
+        if meta is None or meta['rows'] == 0:
+            return np.empty((0, len(COLUMNS)))
+        return np.memmap(self.path, dtype=np.float64, mode='r', shape=(meta['rows'], len(COLUMNS)))
+
+    def _fresh_meta(self, db):
+        return {
+            'version': self._VERSION,
+            'columns': COLUMNS,
+            'definition': hashlib.sha1(db.get_training_definition().encode('utf-8')).hexdigest(),
+            'high_water': 0,
+            'rows': 0,
+            'checksum': 0  # of the cached rows' elo_diff, checked against the DB's (see SaltyDB.get_training_checksum)
+        }
+
+    def _valid(self, db, meta, fresh):
+        for key in ['version', 'columns', 'definition']:
+            if meta.get(key) != fresh[key]:
+                log.info('Training cache %s is out of date: %s changed' % (self.path, key))
+                return False
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < meta['rows'] * len(COLUMNS) * 8:
+            log.warning('Training cache %s is missing rows' % self.path)
+            return False
+        count, last, checksum = db.get_training_checksum(meta['high_water'])
+        if (count, last, checksum) != (meta['rows'], meta['high_water'] if meta['rows'] else 0, meta['checksum']):
+            log.info('Training cache %s is out of date: cached fights changed in the DB' % self.path)
+            return False
+        return True
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    # written next to and then moved over the old one, so a crash never leaves a half written .json
+    def _save_meta(self, meta):
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+
+# the default training cache path for a database: next to SQLite database files, None (no cache) otherwise
+def default_cache_path(database):
+    return saltydb.sidecar_path(database, '.training')
+
+
+# every combination of rate, epochs and non-empty feature subset
+def grid(rates, epochs, features=saltydb.TRAINING_FEATURES):
+    subsets = [list(subset) for n in range(1, len(features) + 1) for subset in itertools.combinations(features, n)]
+    return [{'rate': rate, 'epochs': n_epochs, 'features': subset}
+            for rate, n_epochs, subset in itertools.product(rates, epochs, subsets)]
+
+
+# Trains one candidate on the first n_train rows of the training file and scores it on the rest.
+# Runs in a worker process, so it takes and returns plain values
+def train_candidate(path, n_train, candidate, batch_size, seed):
+    np.random.seed(seed)
+    data = np.load(path, mmap_mode='r')
+    keys = candidate['features'] + ['bias']
+    columns = [COLUMNS.index(key) for key in keys]
+    y_column = COLUMNS.index('winner')
+
+    model = saltyai.LogRegression(keys)
+    x, y = np.ascontiguousarray(data[:n_train, columns]), np.asarray(data[:n_train, y_column])
+    model.fit(x, y, keys, epochs=candidate['epochs'], batch_size=batch_size, alpha=candidate['rate'])
+
+    x, y = data[n_train:, columns], np.asarray(data[n_train:, y_column])
+    p = np.clip(saltyai._sigmoid(x @ model._beta_vector(keys)), 1e-12, 1 - 1e-12)
+    return dict(candidate,
+                log_loss=float(-np.mean(y * np.log(p) + (1 - y) * np.log(1 - p))),
+                accuracy=float(np.mean((p >= 0.5) == (y == 1)) * 100),
+                betas=model.to_json())
+
+
+# trains every candidate across a process pool. returns results sorted best (lowest holdout log loss) first
+def sweep(path, n_rows, candidates, holdout=0.2, workers=None, batch_size=saltyai.LogRegression._BATCH_SIZE, seed=0):
+    n_train = int(n_rows * (1 - holdout))
+    if n_train == 0 or n_train == n_rows:
+        raise ValueError('Holdout leaves no rows to train or test on: %s rows, holdout %s' % (n_rows, holdout))
+    log.info('Sweeping %s candidates: %s training rows, %s holdout rows' % (len(candidates), n_train, n_rows - n_train))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(train_candidate, itertools.repeat(path), itertools.repeat(n_train), candidates,
+                                itertools.repeat(batch_size), range(seed, seed + len(candidates))))
+    return sorted(results, key=lambda result: result['log_loss'])
+
+
+# Trains a new model from the whole training set and saves it, in a process of its own (see SaltySession.setup_models).
+# sends (guid, serialized betas) through conn when done
+# cache_path: TrainingCache to train from with the numpy engine outside of test mode, so only new fights are queried
+def train_worker(conn, database, engine='numpy', batch_size=10000, test_limit=0, echo=False, cache_path=None):
+    logging.basicConfig(format='%(asctime)s-%(processName)s-%(name)s-%(levelname)s: %(message)s', level=logging.INFO)
+    db = saltydb.SaltyDB(database, echo=echo)
+    trained_model = saltyai.LogRegression(saltydb.TRAINING_FEATURES)
+
+    def training_batches():
+        return db.iter_training_batches(batch_size, test_mode=test_limit, test_limit=test_limit)
+
+    use_cache = engine == 'numpy' and cache_path and not test_limit
+    if use_cache:
+        data = TrainingCache(cache_path).update(db, batch_size)
+        found = len(data) > 0
+    else:
+        found = next(training_batches(), None) is not None
+    if not found:
+        log.warning('No new model created because no training data was found.')
+        db.close()
+        return
+
+    if engine != 'numpy':
+        trained_model.train(db.get_training_data(test_mode=test_limit, test_limit=test_limit), 'winner', engine=engine)
+    elif use_cache:
+        trained_model.fit(data[:, :-1], data[:, -1], COLUMNS[:-1])  # strided views of the mmap, nothing is copied up front
+        log.info('Betas: ' + str(trained_model.betas))
+    else:
+        trained_model.train_batches(training_batches, 'winner')
+    betas = trained_model.to_json()
+    conn.send((db.add_ai_logreg_model(betas).guid, betas))
+    conn.close()
+    db.close()
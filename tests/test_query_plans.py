@@ -0,0 +1,36 @@
+from saltybetter.db import saltydb
+import pytest
+
+# point lookups, which must search an index rather than scan anything
+LOOKUPS = ['get_fighter_by_name', 'get_fights', 'get_wins_against', 'get_matchup_stats']
+# ordered reads of a whole table, which must walk an index in order rather than sort
+ORDERED_SCANS = ['backfill_fight_features', 'get_best_logreg_model']
+
+
+@pytest.fixture(scope='module')
+def plans(tmp_path_factory):
+    db = saltydb.SaltyDB('sqlite:///%s' % tmp_path_factory.mktemp('db').joinpath('salt.db'))
+    db.init_db()
+    yield db.explain_hot_queries()
+    db.close()
+
+
+def test_every_hot_query_is_checked(plans):
+    assert sorted(plans) == sorted(LOOKUPS + ORDERED_SCANS)
+
+
+@pytest.mark.parametrize('name', LOOKUPS + ORDERED_SCANS)
+def test_uses_index(plans, name):
+    assert not saltydb.scans_without_index(plans[name]), plans[name]
+
+
+@pytest.mark.parametrize('name', LOOKUPS)
+def test_lookup_searches_index(plans, name):
+    assert any('SEARCH' in line for line in plans[name]), plans[name]
+    assert not any('SCAN' in line for line in plans[name]), plans[name]
+
+
+@pytest.mark.parametrize('name', ORDERED_SCANS)
+def test_ordered_scan_does_not_sort(plans, name):
+    assert not any('TEMP B-TREE' in line for line in plans[name]), plans[name]
+